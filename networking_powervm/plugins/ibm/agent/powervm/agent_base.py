@@ -14,13 +14,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import copy
+import collections
 
 import eventlet
 eventlet.monkey_patch()
+from eventlet import event
 
 from oslo_config import cfg
 from oslo_log import log as logging
+import oslo_messaging
 from oslo_service import loopingcall
 
 from neutron.agent.common import config as a_config
@@ -33,11 +35,13 @@ from pypowervm.helpers import log_helper as log_hlp
 from pypowervm.helpers import vios_busy as vio_hlp
 from pypowervm.utils import uuid as pvm_uuid
 
+from networking_powervm.plugins.ibm.agent.powervm import constants as p_const
 from networking_powervm.plugins.ibm.agent.powervm.i18n import _
 from networking_powervm.plugins.ibm.agent.powervm.i18n import _LI
 from networking_powervm.plugins.ibm.agent.powervm.i18n import _LW
 from networking_powervm.plugins.ibm.agent.powervm import utils
 
+import threading
 import time
 
 
@@ -50,12 +54,47 @@ agent_opts = [
                       "polling when exception is caught")),
     cfg.IntOpt('polling_interval', default=2,
                help=_("The number of seconds the agent will wait between "
-                      "polling for local device changes.")),
+                      "polling for local device changes.  The agent is woken "
+                      "earlier when a port update or device event arrives.")),
+    cfg.FloatOpt('provision_batch_window', default=0.1,
+                 help=_("The number of seconds the agent waits after being "
+                        "woken for a port update or device event before "
+                        "processing it.  Allows a burst of updates to be "
+                        "provisioned together.")),
+    cfg.IntOpt('max_pending_port_updates', default=1000,
+               help=_("The maximum number of distinct ports with updates "
+                      "from Neutron that may be waiting to be processed.  "
+                      "When reached, further updates wait (up to the polling "
+                      "interval) for the agent to catch up.")),
+    cfg.IntOpt('unknown_mac_cache_ttl', default=300,
+               help=_("The number of seconds the agent remembers that "
+                      "Neutron has no port for a MAC address (for example, "
+                      "the adapters of the management partition), rather "
+                      "than asking Neutron again.  A port update for the "
+                      "MAC address ends it early.  0 disables the cache.")),
+    cfg.IntOpt('unknown_mac_cache_size', default=4096,
+               help=_("The maximum number of MAC addresses unknown to "
+                      "Neutron to remember.")),
+    cfg.IntOpt('device_details_cache_ttl', default=60,
+               help=_("The number of seconds the agent reuses the device "
+                      "details that Neutron returned for a port.  Port "
+                      "updates and network deletes end it early.  0 "
+                      "disables the cache.")),
+    cfg.IntOpt('device_details_cache_size', default=4096,
+               help=_("The maximum number of device details to cache.")),
+    cfg.FloatOpt('device_status_flush_interval', default=0.5,
+                 help=_("The number of seconds the agent collects the "
+                        "changes to the status (up or down) of devices "
+                        "before reporting them to Neutron together.")),
+    cfg.IntOpt('device_status_batch_size', default=100,
+               help=_("The number of device status changes that are "
+                      "reported to Neutron as soon as they are collected, "
+                      "rather than waiting for the flush interval.")),
     cfg.IntOpt('heal_and_optimize_interval', default=300,
                help=_('The number of seconds the agent should wait between '
-                      'heal/optimize intervals.  Should be higher than the '
-                      'polling_interval as it runs in the nearest polling '
-                      'loop.'))
+                      'heal/optimize intervals.  The heal runs in the '
+                      'background, in its own greenthread, so the '
+                      'provisioning of new ports continues while it runs.'))
 ]
 
 cfg.CONF.register_opts(agent_opts, "AGENT")
@@ -82,7 +121,9 @@ class PVMRpcCallbacks(object):
     #  1.0 Initial version
     #  1.1 Support Security Group RPC
     #  1.2 Support DVR (Distributed Virtual Router) RPC
-    RPC_API_VERSION = '1.1'
+    #  1.3 Support bulk ports_update RPC (from the PowerVM mechanism driver)
+    RPC_API_VERSION = p_const.RPC_VERSION_PORTS_UPDATE
+    target = oslo_messaging.Target(version=RPC_API_VERSION)
 
     def __init__(self, agent):
         """
@@ -99,11 +140,161 @@ class PVMRpcCallbacks(object):
         self.agent._update_port(port)
         LOG.debug("port_update RPC received for port: %s", port['id'])
 
+    def ports_update(self, context, **kwargs):
+        """Bulk form of port_update, for a batch of ports bound together.
+
+        :param ports: A list of dictionaries, each with the 'port' (and the
+                      rest of the arguments) of a port_update.
+        """
+        ports = kwargs['ports']
+        for entry in ports:
+            self.agent._update_port(entry['port'])
+        LOG.debug("ports_update RPC received for ports: %s",
+                  [x['port']['id'] for x in ports])
+
     def network_delete(self, context, **kwargs):
         network_id = kwargs.get('network_id')
+        self.agent._delete_network(network_id)
         LOG.debug("network_delete RPC received for network: %s", network_id)
 
 
+class PortUpdateQueue(object):
+    """Coalesces the port updates from Neutron, keyed by the port id.
+
+    Only the latest update for a port is kept, so a storm of updates for a
+    handful of ports results in only a handful of device lookups.  The queue
+    is bounded.  When full, a new port waits for the queue to be drained
+    before it is added.  If the queue still isn't drained, the port is added
+    anyway (updates are never dropped) and the overflow is counted.
+    """
+
+    def __init__(self, max_size, on_full=None):
+        """Creates the queue.
+
+        :param max_size: The maximum number of distinct ports in the queue.
+        :param on_full: (Optional) Called when a port has to wait on a full
+                        queue.  Should prompt the consumer to drain it.
+        """
+        self.max_size = max_size
+        self.on_full = on_full
+        self._ports = collections.OrderedDict()
+        self._drained = threading.Event()
+        self.received = 0
+        self.coalesced = 0
+        self.overflows = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self._ports)
+
+    def put(self, port, timeout):
+        """Adds a port update to the queue.
+
+        :param port: The port dictionary from Neutron.
+        :param timeout: The number of seconds to wait for the queue to be
+                        drained, if it is full.
+        """
+        self.received += 1
+        port_id = port.get('id')
+        if port_id not in self._ports and len(self._ports) >= self.max_size:
+            self._drained.clear()
+            if self.on_full is not None:
+                self.on_full()
+            self._drained.wait(timeout)
+            if len(self._ports) >= self.max_size:
+                self.overflows += 1
+                LOG.warn(_LW("The port update queue is over its maximum "
+                             "size of %d."), self.max_size)
+
+        if port_id in self._ports:
+            self.coalesced += 1
+        self._ports[port_id] = port
+        self.high_water = max(self.high_water, len(self._ports))
+
+    def swap(self):
+        """Returns (and then resets) the queued port updates."""
+        ports, self._ports = self._ports, collections.OrderedDict()
+        self._drained.set()
+        return list(ports.values())
+
+    @property
+    def stats(self):
+        """Returns the counters for the queue."""
+        return {'size': len(self._ports), 'received': self.received,
+                'coalesced': self.coalesced, 'overflows': self.overflows,
+                'high_water': self.high_water}
+
+
+class TTLCache(object):
+    """A size bounded cache whose entries expire after a time to live.
+
+    When full, the least recently added entry is evicted.  The hits and
+    misses on get are counted so that the effectiveness of the cache can be
+    reported.
+    """
+
+    def __init__(self, ttl, max_size):
+        """Creates the cache.
+
+        :param ttl: The number of seconds an entry lives.  If 0, nothing is
+                    cached.
+        :param max_size: The maximum number of entries.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the live value for the key, or the default."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.time():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        """Adds (or replaces) the value for the key."""
+        if self.ttl <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + self.ttl, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """Removes the key from the cache, if present."""
+        self._entries.pop(key, None)
+
+    def evict(self, func):
+        """Removes the entries whose value matches.
+
+        :param func: Takes in a value, and returns True if its entry should
+                     be removed.
+        """
+        for key in [k for k, v in self._entries.items() if func(v[1])]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def stats(self):
+        """Returns the size and hit/miss counts of the cache."""
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0}
+
+
 class ProvisionRequest(object):
     """A request for a Neutron Port to be provisioned.
 
@@ -150,16 +341,47 @@ class BasePVMNeutronAgent(object):
     def __init__(self, binary_name, agent_type):
         self.agent_state = {'binary': binary_name, 'host': cfg.CONF.host,
                             'topic': q_const.L2_AGENT_TOPIC,
-                            'configurations': {}, 'agent_type': agent_type,
+                            'configurations': {
+                                p_const.AGENT_CAP_HOST_TOPIC: True,
+                                p_const.AGENT_CAP_PORTS_UPDATE: True},
+                            'agent_type': agent_type,
                             'start_flag': True}
+
+        # Signalled when there is new work for the rpc_loop.
+        self._wakeup = threading.Event()
+
+        # The MAC addresses that Neutron has recently said it has no port
+        # for.  These are not asked about again until they expire, or a port
+        # update comes in for them.
+        self.unknown_macs = TTLCache(ACONF.unknown_mac_cache_ttl,
+                                     ACONF.unknown_mac_cache_size)
+
+        # The device details from Neutron, by MAC address.  The in flight
+        # requests let concurrent callers share one request to Neutron.
+        self.device_details = TTLCache(ACONF.device_details_cache_ttl,
+                                       ACONF.device_details_cache_size)
+        self._inflight = {}
+
+        # The device status changes (True for up) yet to be sent to Neutron.
+        self._device_status = collections.OrderedDict()
+        self._bulk_device_status = True
+
+        # The heal and optimize runs in the background.  The metrics cover
+        # its duration and the provisioning latency while it runs.
+        self._heal_thread = None
+        self.heal_stats = {'runs': 0, 'last_duration': 0.0,
+                           'max_duration': 0.0, 'provisions_during_heal': 0,
+                           'max_provision_latency_during_heal': 0.0}
+
         self.setup_rpc()
 
         # Create the utility class that enables work against the Hypervisors
         # Shared Ethernet NetworkBridge.
         self.setup_adapter()
 
-        # A list of ports that maintains the list of current 'modified' ports
-        self.updated_ports = []
+        # The current 'modified' ports, latest update per port.
+        self.updated_ports = PortUpdateQueue(ACONF.max_pending_port_updates,
+                                             on_full=self.wake)
 
     def setup_adapter(self):
         """Configures the pypowervm adapter and utilities."""
@@ -182,14 +404,21 @@ class BasePVMNeutronAgent(object):
         self.endpoints = [PVMRpcCallbacks(self)]
 
         # Define the listening consumers for the agent.  ML2 only supports
-        # these two update types.
-        consumers = [[topics.PORT, topics.UPDATE],
+        # these two update types.  The port updates are also consumed from
+        # a topic specific to this host, which the mechanism driver uses to
+        # notify only the agent on the binding host.
+        consumers = [[topics.PORT, topics.UPDATE, cfg.CONF.host],
                      [topics.NETWORK, topics.DELETE]]
 
         self.connection = agent_rpc.create_consumers(self.endpoints,
                                                      self.topic,
                                                      consumers)
 
+        # The device status changes are sent to Neutron periodically.
+        flusher = loopingcall.FixedIntervalLoopingCall(
+            self.flush_device_status)
+        flusher.start(interval=ACONF.device_status_flush_interval)
+
         # Report interval is for the agent health check.
         report_interval = cfg.CONF.AGENT.report_interval
         if report_interval:
@@ -214,14 +443,78 @@ class BasePVMNeutronAgent(object):
             LOG.exception(_("Failed reporting state!"))
 
     def update_device_up(self, device):
-        """Calls back to neutron that a device is alive."""
-        self.plugin_rpc.update_device_up(self.context, device['device'],
-                                         self.agent_id, cfg.CONF.host)
+        """Calls back to neutron that a device is alive.
+
+        The status is sent (along with any others) on the next flush.
+        """
+        self._queue_device_status(device['device'], True)
 
     def update_device_down(self, device):
-        """Calls back to neutron that a device is down."""
-        self.plugin_rpc.update_device_down(self.context, device['device'],
-                                           self.agent_id, cfg.CONF.host)
+        """Calls back to neutron that a device is down.
+
+        The status is sent (along with any others) on the next flush.
+        """
+        self._queue_device_status(device['device'], False)
+
+    def _queue_device_status(self, device, up):
+        # Only the latest status of a device matters.
+        self._device_status.pop(device, None)
+        self._device_status[device] = up
+        if len(self._device_status) >= ACONF.device_status_batch_size:
+            self.flush_device_status()
+
+    def flush_device_status(self):
+        """Sends the queued device status changes to Neutron.
+
+        They are sent in a single update_device_list call.  If Neutron does
+        not support it, each device is sent separately.
+        """
+        statuses, self._device_status = (self._device_status,
+                                         collections.OrderedDict())
+        if not statuses:
+            return
+
+        devices_up = [x for x, up in statuses.items() if up]
+        devices_down = [x for x, up in statuses.items() if not up]
+        try:
+            if (self._bulk_device_status and
+                    hasattr(self.plugin_rpc, 'update_device_list')):
+                try:
+                    self._update_device_list(devices_up, devices_down)
+                    return
+                except (oslo_messaging.UnsupportedVersion,
+                        oslo_messaging.RemoteError) as e:
+                    if (isinstance(e, oslo_messaging.RemoteError) and
+                            e.exc_type != 'UnsupportedVersion'):
+                        raise
+                    LOG.info(_LI("Neutron does not support bulk device "
+                                 "status updates.  Updating each device."))
+                    self._bulk_device_status = False
+
+            for device in devices_up:
+                self.plugin_rpc.update_device_up(
+                    self.context, device, self.agent_id, cfg.CONF.host)
+                statuses.pop(device)
+            for device in devices_down:
+                self.plugin_rpc.update_device_down(
+                    self.context, device, self.agent_id, cfg.CONF.host)
+                statuses.pop(device)
+        except Exception:
+            # Retry the devices on the next flush, unless their status has
+            # changed since.
+            LOG.exception(_("Failed updating the status of devices."))
+            for device, up in statuses.items():
+                self._device_status.setdefault(device, up)
+
+    def _update_device_list(self, devices_up, devices_down):
+        resp = self.plugin_rpc.update_device_list(
+            self.context, devices_up, devices_down, self.agent_id,
+            cfg.CONF.host) or {}
+        failed = (resp.get('failed_devices_up', []) +
+                  resp.get('failed_devices_down', []))
+        if failed:
+            LOG.warn(_LW("Neutron failed to update the status of devices "
+                         "%s."), failed)
 
     def get_device_details(self, device_mac):
         """Returns a neutron device for a given mac address.
@@ -229,33 +522,131 @@ class BasePVMNeutronAgent(object):
         :param device_mac: The neutron mac addresses for the device to get.
         :return: The device from neutron.
         """
-        return self.plugin_rpc.get_device_details(self.context, device_mac,
-                                                  self.agent_id)
+        return self.get_devices_details_list([device_mac])[0]
 
     def get_devices_details_list(self, device_macs):
         """Returns list of neutron devices for a list of mac addresses.
 
+        The device details are cached.  MAC addresses that Neutron recently
+        had no port for are not sent to Neutron.  Like Neutron, an empty
+        device (with just the 'device' key) is returned for them.  If another
+        caller is already asking Neutron about a MAC address, its response is
+        shared rather than asking again.
+
         :param device_macs: List of neutron mac addresses for the devices to
                             get.
         :return: The list of devices from neutron.
         """
-        return self.plugin_rpc.get_devices_details_list(
-            self.context, device_macs, self.agent_id)
+        found, waits, flights = {}, {}, collections.OrderedDict()
+        for mac in device_macs:
+            if mac in found or mac in waits or mac in flights:
+                continue
+            if self.unknown_macs.get(mac, False):
+                found[mac] = {'device': mac}
+                continue
+            dev = self.device_details.get(mac)
+            if dev is not None:
+                found[mac] = dev
+            elif mac in self._inflight:
+                waits[mac] = self._inflight[mac]
+            else:
+                flights[mac] = self._inflight[mac] = event.Event()
+
+        if flights:
+            query_macs = list(flights.keys())
+            exc = None
+            try:
+                q_devs = self.plugin_rpc.get_devices_details_list(
+                    self.context, query_macs, self.agent_id)
+
+                # Neutron responds in the order of the request.
+                for mac, dev in zip(query_macs, q_devs):
+                    found[mac] = dev
+                    self._end_flight(mac, flight=flights[mac], dev=dev)
+            except Exception as e:
+                exc = e
+                raise
+            finally:
+                # Every flight must end, or its waiters block forever.  Those
+                # that Neutron did not respond to get an empty device.
+                for mac, flight in flights.items():
+                    if flight.ready():
+                        continue
+                    if exc is None:
+                        found[mac] = {'device': mac}
+                    self._end_flight(mac, flight, dev={'device': mac},
+                                     exc=exc)
+
+        for mac, flight in waits.items():
+            found[mac] = flight.wait()
+
+        return [found[x] for x in device_macs if x in found]
+
+    def _end_flight(self, mac, flight, dev=None, exc=None):
+        """Completes an in flight device details request for a MAC address.
+
+        Caches the result, unless the MAC address was invalidated while the
+        request was in flight, and hands it to the callers waiting on it.
+        """
+        if self._inflight.get(mac) is flight:
+            del self._inflight[mac]
+            if exc is None and mac:
+                if dev.get('mac_address'):
+                    self.device_details.put(mac, dev)
+                else:
+                    self.unknown_macs.put(mac, True)
+
+        if exc is None:
+            flight.send(dev)
+        else:
+            flight.send_exception(exc)
+
+    def _invalidate_device(self, mac):
+        """Forgets what Neutron said about a MAC address."""
+        self.unknown_macs.pop(mac)
+        self.device_details.pop(mac)
+        self._inflight.pop(mac, None)
+
+    def _delete_network(self, network_id):
+        """Invoked to indicate that a network was deleted within Neutron."""
+        self.device_details.evict(lambda x: x.get('network_id') == network_id)
 
     def _update_port(self, port):
         """Invoked to indicate that a port has been updated within Neutron."""
         LOG.info(_LI('Neutron API indicated port update for %(mac)s.  '
                      'Checking if hosted by this system.'),
                  {'mac': port.get('mac_address')})
-        self.updated_ports.append(port)
+        self._invalidate_device(port.get('mac_address'))
+        self.updated_ports.put(port, ACONF.polling_interval)
+        self.wake()
+
+    def wake(self):
+        """Wakes the rpc_loop to indicate that there is new work for it."""
+        self._wakeup.set()
+
+    def _wait_for_work(self):
+        """Blocks until the rpc_loop is woken, or the polling interval ends.
+
+        If woken, waits a further (short) batching window so that a burst of
+        updates is processed together.
+        """
+        if (self._wakeup.wait(ACONF.polling_interval) and
+                ACONF.provision_batch_window > 0):
+            time.sleep(ACONF.provision_batch_window)
+
+        # Cleared before the work is gathered, so a wake up that comes in
+        # during the gathering is not lost.
+        self._wakeup.clear()
 
     def _list_updated_ports(self):
         """
         Will return (and then reset) the list of updated ports received
         from the system.
         """
-        ports = copy.copy(self.updated_ports)
-        self.updated_ports = []
+        ports = self.updated_ports.swap()
+        if ports:
+            LOG.debug("Port update queue statistics: %s",
+                      self.updated_ports.stats)
         return ports
 
     def heal_and_optimize(self, is_boot):
@@ -304,10 +695,14 @@ class BasePVMNeutronAgent(object):
 
         while True:
             try:
-                # If the loop interval has passed, heal and optimize
-                if time.time() - loop_timer > loop_interval:
+                # If the loop interval has passed, heal and optimize.  The
+                # heal runs in the background, so that the provisioning of
+                # new ports continues.
+                if (self._heal_thread is None and
+                        time.time() - loop_timer > loop_interval):
                     LOG.debug("Performing heal and optimization of system.")
-                    self.heal_and_optimize(first_loop)
+                    self._heal_thread = eventlet.spawn(self._heal,
+                                                       first_loop)
                     first_loop = False
                     loop_timer = time.time()
 
@@ -323,11 +718,11 @@ class BasePVMNeutronAgent(object):
                 tot_prov_reqs = n_prov_reqs + s_prov_reqs
                 tot_prov_reqs = list(set(tot_prov_reqs))
 
-                # If there are no updated ports, just sleep and re-loop
+                # If there are no updated ports, wait for some and re-loop
                 if not tot_prov_reqs:
-                    LOG.debug("No changes, sleeping %d seconds.",
+                    LOG.debug("No changes, waiting up to %d seconds.",
                               ACONF.polling_interval)
-                    time.sleep(ACONF.polling_interval)
+                    self._wait_for_work()
                     continue
 
                 # Provision the ports on the Network Bridge.
@@ -340,6 +735,25 @@ class BasePVMNeutronAgent(object):
                 # sleep for a while and re-loop
                 time.sleep(ACONF.exception_interval)
 
+    def _heal(self, is_boot):
+        """Runs the heal_and_optimize, and records its duration."""
+        start = time.time()
+        try:
+            self.heal_and_optimize(is_boot)
+        except Exception as e:
+            LOG.exception(e)
+            LOG.warn(_LW("Error has been encountered during the heal and "
+                         "optimization of the system.  It will be retried "
+                         "at the next interval."))
+        finally:
+            duration = time.time() - start
+            self.heal_stats['runs'] += 1
+            self.heal_stats['last_duration'] = duration
+            self.heal_stats['max_duration'] = max(
+                self.heal_stats['max_duration'], duration)
+            self._heal_thread = None
+            LOG.debug("Heal and optimize statistics: %s", self.heal_stats)
+
     def build_prov_requests_from_neutron(self):
         """Builds the provisioning requests from the Neutron Server.
 
@@ -348,36 +762,39 @@ class BasePVMNeutronAgent(object):
 
         :return: A list of the ProvisionRequests that have come from Neutron.
         """
-        # Convert the ports to devices.
-        u_ports = self._list_updated_ports()
-        dev_list = [x.get('mac_address') for x in u_ports]
-        devices = self.get_devices_details_list(dev_list)
-
-        # Build the network devices
-        resp = []
-        for port in u_ports:
+        # Only ports with a UUID, bound to this agent's host, are of
+        # interest.  Port updates are fanned out to every agent, so the
+        # ports meant to provision on another agent are dropped before
+        # asking the server for their device details.
+        u_ports = {}
+        for port in self._list_updated_ports():
             port_uuid = port.get('id')
-
-            # Make sure we have a UUID
             if port_uuid is None:
                 continue
-
-            # Make sure the binding host matches this agent.  Otherwise it is
-            # meant to provision on another agent.
             if port.get('binding:host_id') != cfg.CONF.host:
                 continue
+            u_ports[port_uuid] = port
 
-            for dev in devices:
-                # If the device's id (really the port uuid) doesn't match,
-                # ignore it.
-                dev_pid = dev.get('port_id')
-                if dev_pid is None or port_uuid != dev_pid:
-                    continue
+        if not u_ports:
+            return []
+
+        # Convert the ports to devices.
+        dev_list = [x.get('mac_address') for x in u_ports.values()]
+        devices = self.get_devices_details_list(dev_list)
 
-                # Valid request.  Add it
-                device_id = port.get('device_id')
-                lpar_uuid = pvm_uuid.convert_uuid_to_pvm(device_id).upper()
-                resp.append(ProvisionRequest(dev, lpar_uuid))
+        # Build the network devices
+        resp = []
+        for dev in devices:
+            # The device's id (really the port uuid) must match one of the
+            # updated ports.
+            port = u_ports.get(dev.get('port_id'))
+            if port is None:
+                continue
+
+            # Valid request.  Add it
+            device_id = port.get('device_id')
+            lpar_uuid = pvm_uuid.convert_uuid_to_pvm(device_id).upper()
+            resp.append(ProvisionRequest(dev, lpar_uuid))
         return resp
 
     def build_prov_requests_from_server(self):
@@ -392,6 +809,20 @@ class BasePVMNeutronAgent(object):
         """
         pass
 
+    def record_provision_latency(self, start):
+        """Records the latency of a provisioning that ran during a heal.
+
+        The agent implementations call this once the provisioning of a set of
+        devices has completed.
+
+        :param start: The time at which the provisioning began.
+        """
+        if self._heal_thread is not None:
+            self.heal_stats['provisions_during_heal'] += 1
+            self.heal_stats['max_provision_latency_during_heal'] = max(
+                self.heal_stats['max_provision_latency_during_heal'],
+                time.time() - start)
+
     def attempt_provision(self, provision_reqs):
         """Attempts the provisioning of ports.
 
@@ -16,3 +16,12 @@
 
 AGENT_TYPE_PVM_SEA = 'PowerVM Shared Ethernet agent'
 VIF_TYPE_PVM_SEA = 'pvm_sea'
+
+# The agent RPC API version that introduced the bulk ports_update method, and
+# the flag the agent reports in its configurations to advertise it.
+RPC_VERSION_PORTS_UPDATE = '1.3'
+AGENT_CAP_PORTS_UPDATE = 'ports_update'
+
+# The flag the agent reports in its configurations to advertise that it
+# listens for port updates on the topic specific to its host.
+AGENT_CAP_HOST_TOPIC = 'port_update_host_topic'
@@ -14,9 +14,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import copy
 import eventlet
 eventlet.monkey_patch()
+from eventlet import event
+from eventlet import queue
+import functools
+import threading
 import time
 
 from oslo_concurrency import lockutils
@@ -50,16 +55,17 @@ agent_opts = [
                     'Shared Ethernet Adapters.'
                     'Format: <ph_net1>:<sea1>:<vio1>,<ph_net2>:<sea2>:<vio2> '
                     'Example: default:ent5:vios_1,speedy:ent6:vios_1'),
-    cfg.IntOpt('pvid_update_loops', default=180,
+    cfg.IntOpt('pvid_update_timeout', default=180,
+               deprecated_name='pvid_update_loops',
                help='The Port VLAN ID (PVID) of the Client VM\'s Network '
                     'Interface is updated by this agent.  There is a delay '
                     'from Nova between when the Neutron Port is assigned '
                     'to the host, and when the client VIF is created.  This '
-                    'variable indicates how many loops the agent should take '
-                    'until it determines that the port has failed to create '
-                    'from Nova.  If no requests are in the system, the loop '
-                    'will wait a second before checking again.  If requests '
-                    'are in the system, it may take a bit longer.'),
+                    'variable indicates how many seconds the agent should '
+                    'wait for the client VIF until it determines that the '
+                    'port has failed to create from Nova.  The agent is '
+                    'notified as the client VIF is created, so waits no '
+                    'longer than needed.'),
     cfg.BoolOpt('automated_powervm_vlan_cleanup', default=True,
                 help='Determines whether or not the VLANs will be removed '
                      'from the Network Bridge if a VM is removed and it is '
@@ -67,7 +73,33 @@ agent_opts = [
                      'default, will clean up VLANs to improve the overall '
                      'system performance (by reducing broadcast domain).  '
                      'Will only apply to VLANs not on the primary PowerVM '
-                     'virtual Ethernet adapter of the SEA.')
+                     'virtual Ethernet adapter of the SEA.'),
+    cfg.IntOpt('vlan_cleanup_batch_size', default=32, min=1,
+               help='The maximum number of unused VLANs that are removed '
+                    'from a Network Bridge on each full heal.  They are '
+                    'removed in a single update of the bridge, so this '
+                    'bounds the size of that update.  The rest are removed '
+                    'on the following full heals.'),
+    cfg.IntOpt('nb_write_window_ms', default=100,
+               help='The number of milliseconds that the VLAN changes to a '
+                    'Network Bridge are gathered for, before they are made '
+                    'together: one update for all of the VLANs added, and '
+                    'one for all of the VLANs removed.'),
+    cfg.IntOpt('heal_full_sweep_interval', default=3600,
+               help='The number of seconds between full heals of the '
+                    'system, which read every network adapter and network '
+                    'bridge.  The heals in between only look at the virtual '
+                    'machines and network bridges that have changed.'),
+    cfg.IntOpt('cna_event_workers', default=4,
+               help='The number of workers that concurrently look up the '
+                    'network adapters (and their Neutron ports) for the '
+                    'virtual machines that the PowerVM API reports as '
+                    'changed.'),
+    cfg.IntOpt('cna_event_debounce_ms', default=250,
+               help='The number of milliseconds to wait after an event for '
+                    'a virtual machine before looking up its network '
+                    'adapters.  Repeated events for the virtual machine '
+                    'within that time are handled by a single lookup.')
 ]
 
 
@@ -84,7 +116,8 @@ class CNAEventHandler(pvm_adpt.EventHandler):
     This event handler will be invoked by the PowerVM API when something occurs
     on the system.  This event handler will determine if it could have been
     related to a network change.  If so, then it will add a ProvisionRequest
-    to the processing queue.
+    to the processing queue.  The REST and RPC calls needed to build the
+    requests are made by a set of workers, rather than the event callback.
     """
 
     def __init__(self, agent):
@@ -93,26 +126,110 @@ class CNAEventHandler(pvm_adpt.EventHandler):
         self.host_uuid = self.agent.host_uuid
         self.prov_req_queue = []
 
-    @lockutils.synchronized('cna_request_queue')
+        # The event callback only queues the URIs (with the time they came
+        # in).  The workers do the REST and RPC calls to resolve them, so
+        # that a slow server doesn't hold up the delivery of events.
+        self._uri_queue = queue.Queue()
+
+        # The URIs that are queued, but not yet being resolved.  Further
+        # events for them within the debounce window are coalesced.
+        self._pending_uris = set()
+        self.received = 0
+        self.queue_high_water = 0
+        self.processed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._workers = [eventlet.spawn(self._worker)
+                         for x in range(ACONF.cna_event_workers)]
+
     def process(self, events):
         for uri, action in events.items():
+            # Any event may be a change to the network topology.
+            if self.agent.topology.invalidate_for_uri(uri):
+                self.agent.mark_topology_dirty()
+
+            # The API event system was refreshed, so the indexed adapters
+            # can no longer be trusted.
+            if uri == 'general' and action == 'invalidate':
+                self.agent.cna_index.clear()
+                self.agent.request_full_heal()
+                continue
+
+            lpar_uuid = self._lpar_uuid_for_uri(uri)
+            if lpar_uuid is not None:
+                self.agent.mark_lpar_dirty(lpar_uuid)
+
             if action in ['add', 'invalidate']:
-                self.prov_req_queue.extend(self._prov_reqs_for_uri(uri))
+                self.received += 1
+                if uri in self._pending_uris:
+                    continue
+                self._pending_uris.add(uri)
+                self._uri_queue.put((uri, time.time()))
+                self.queue_high_water = max(self.queue_high_water,
+                                            self._uri_queue.qsize())
+            elif action == 'delete':
+                if lpar_uuid is not None:
+                    self.agent.cna_index.remove(lpar_uuid)
+
+    def _worker(self):
+        """Resolves the queued URIs into ProvisionRequests, until killed."""
+        while True:
+            uri, queued = self._uri_queue.get()
 
-    def _prov_reqs_for_uri(self, uri):
-        """Returns set of ProvisionRequests for a URI.
+            # Let the burst of events for the URI settle.  Events that come
+            # in once the lookup starts queue the URI again.
+            delay = queued + ACONF.cna_event_debounce_ms / 1000.0 - time.time()
+            if delay > 0:
+                eventlet.sleep(delay)
+            self._pending_uris.discard(uri)
 
-        When the API indicates that a URI is invalid, it will return a
-        List of ProvisionRequests for a given URI.  If the URI is not valid
-        for a ClientNetworkAdapter (CNA) then an empty list will be returned.
+            try:
+                p_reqs = self._prov_reqs_for_uri(uri)
+                if p_reqs:
+                    self._add_to_queue(p_reqs)
+                    self.agent.wake()
+            except Exception:
+                LOG.exception(_LE('Error resolving the event for URI %s.'),
+                              uri)
+            finally:
+                latency = time.time() - queued
+                self.processed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self._uri_queue.task_done()
+
+    @lockutils.synchronized('cna_request_queue')
+    def _add_to_queue(self, p_reqs):
+        self.prov_req_queue.extend(p_reqs)
+
+    @property
+    def stats(self):
+        """Returns the depth and latency metrics of the URI queue.
+
+        The received count is the number of add and invalidate events, where
+        the processed count is the number of lookups they resulted in.
+        """
+        avg = self.total_latency / self.processed if self.processed else 0.0
+        return {'depth': self._uri_queue.qsize(),
+                'received': self.received,
+                'high_water': self.queue_high_water,
+                'processed': self.processed, 'avg_latency': avg,
+                'max_latency': self.max_latency}
+
+    def _lpar_uuid_for_uri(self, uri):
+        """Returns the LogicalPartition UUID for a URI.
+
+        :param uri: The URI from the event.
+        :return: The UUID of the LogicalPartition.  If the URI is not for a
+                 LogicalPartition, None is returned.
         """
         try:
             if not pvm_util.is_instance_path(uri):
-                return []
+                return None
         except Exception:
             LOG.warn(_LW('Unable to parse URI %s for provision request '
                          'assessment.'), uri)
-            return []
+            return None
 
         # The event queue will only return URI's for 'root like' objects.
         # This is essentially just the LogicalPartition, you can't get the
@@ -123,16 +240,36 @@ class CNAEventHandler(pvm_adpt.EventHandler):
         # LogicalPartition's
         uuid = pvm_util.get_req_path_uuid(uri, preserve_case=True)
         if not uri.endswith('LogicalPartition/' + uuid):
+            return None
+        return uuid
+
+    def _prov_reqs_for_uri(self, uri):
+        """Returns set of ProvisionRequests for a URI.
+
+        When the API indicates that a URI is invalid, it will return a
+        List of ProvisionRequests for a given URI.  If the URI is not valid
+        for a ClientNetworkAdapter (CNA) then an empty list will be returned.
+        """
+        uuid = self._lpar_uuid_for_uri(uri)
+        if uuid is None:
             return []
 
-        # For the LPAR, get the CNAs.
+        # For the LPAR, get the CNAs.  Keep the agent's index of the adapters
+        # current while we have them.
         cna_wraps = utils.list_cnas(self.adapter, self.host_uuid, uuid)
-        resp = []
-        for cna_w in cna_wraps:
-            # Build a provision request for each type
-            device_mac = utils.norm_mac(cna_w.mac)
-            device_detail = self.agent.get_device_details(device_mac)
+        self.agent.cna_index.update(uuid, cna_wraps)
+
+        # A PVID update may be waiting on the LPAR's adapters.
+        self.agent.pvid_updater.wake(lpar_uuid=uuid)
+        if not cna_wraps:
+            return []
 
+        # Get the device details for all of the LPAR's adapters at once.
+        device_macs = [utils.norm_mac(x.mac) for x in cna_wraps]
+        device_details = self.agent.get_devices_details_list(device_macs)
+
+        resp = []
+        for device_detail in device_details:
             # A device detail will always come back...even if neutron has
             # no idea what the port is.  This WILL happen for PowerVM, maybe
             # an event for the mgmt partition or the secure RMC VIF.  We can
@@ -149,8 +286,145 @@ class CNAEventHandler(pvm_adpt.EventHandler):
     def get_queue(self):
         resp = copy.copy(self.prov_req_queue)
         self.prov_req_queue = []
+        if resp:
+            LOG.debug("CNA event queue statistics: %s", self.stats)
+        return resp
+
+
+class CNAIndex(object):
+    """An in memory index of the Client Network Adapters on the host.
+
+    The index is keyed by the LPAR UUID and then by the MAC address of the
+    adapter.  It is kept current by the CNAEventHandler, which hands it the
+    adapters it reads on 'add' and 'invalidate' events and drops the LPARs
+    that are deleted.  Lookups against a warm index make no REST calls.  A
+    lookup that misses the index falls back to reading the LPAR's adapters.
+    """
+
+    def __init__(self, adapter, host_uuid):
+        """Creates the index.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The UUID for the host system.
+        """
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        self._index = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _mac_key(mac):
+        return pvm_util.sanitize_mac_for_api(mac)
+
+    def update(self, lpar_uuid, cna_wraps):
+        """Replaces the indexed adapters for an LPAR.
+
+        :param lpar_uuid: The UUID of the LPAR.
+        :param cna_wraps: The complete list of CNA wrappers for the LPAR.
+        """
+        self._index[lpar_uuid] = {self._mac_key(x.mac): x for x in cna_wraps}
+
+    def put(self, lpar_uuid, cna_wrap):
+        """Replaces a single indexed adapter, such as after an update to it.
+
+        Nothing is done if the LPAR is not indexed.
+
+        :param lpar_uuid: The UUID of the LPAR.
+        :param cna_wrap: The CNA wrapper.
+        """
+        cnas = self._index.get(lpar_uuid)
+        if cnas is not None:
+            cnas[self._mac_key(cna_wrap.mac)] = cna_wrap
+
+    def remove(self, lpar_uuid):
+        """Removes an LPAR (and all its adapters) from the index."""
+        self._index.pop(lpar_uuid, None)
+
+    def clear(self):
+        """Empties the index.  Subsequent lookups will read from the API."""
+        self._index = {}
+
+    def reset(self, lpar_cnas):
+        """Replaces the whole index.
+
+        :param lpar_cnas: A dictionary of every LPAR UUID on the system to
+                          the complete list of its CNA wrappers.
+        """
+        self._index = {}
+        for lpar_uuid, cna_wraps in lpar_cnas.items():
+            self.update(lpar_uuid, cna_wraps)
+
+    def all_cnas(self):
+        """Returns all of the indexed adapters, without reading the API."""
+        return [cna for cnas in self._index.values() for cna in cnas.values()]
+
+    def list_cnas(self, lpar_uuid):
+        """Returns the adapters for an LPAR, reading them if not indexed.
+
+        :param lpar_uuid: The UUID of the LPAR.
+        :return: The list of CNA wrappers for the LPAR.
+        """
+        cnas = self._index.get(lpar_uuid)
+        if cnas is None:
+            cna_wraps = utils.list_cnas(self.adapter, self.host_uuid,
+                                        lpar_uuid=lpar_uuid)
+            self.update(lpar_uuid, cna_wraps)
+            return cna_wraps
+        return list(cnas.values())
+
+    def find(self, lpar_uuid, mac):
+        """Returns the adapter for a given LPAR and MAC address.
+
+        :param lpar_uuid: The UUID of the LPAR.
+        :param mac: The MAC address of the adapter.  May be in either the
+                    pypowervm or Neutron format.
+        :return: The CNA wrapper.  If one isn't found (even after reading
+                 from the API), None is returned.
+        """
+        return self.find_many([(lpar_uuid, mac)]).get((lpar_uuid, mac))
+
+    def find_many(self, keys):
+        """Returns the adapters for a set of LPAR and MAC address pairs.
+
+        The LPARs that miss the index are read once each (no matter how many
+        of their MAC addresses were requested), concurrently.
+
+        :param keys: An iterable of (LPAR UUID, MAC address) tuples.
+        :return: A dictionary of the (LPAR UUID, MAC address) tuple to the CNA
+                 wrapper.  Keys that could not be found are not included.
+        """
+        resp = {}
+        missed = {}
+        for lpar_uuid, mac in keys:
+            cna = self._index.get(lpar_uuid, {}).get(self._mac_key(mac))
+            if cna is None:
+                self.misses += 1
+                missed.setdefault(lpar_uuid, []).append(mac)
+            else:
+                self.hits += 1
+                resp[(lpar_uuid, mac)] = cna
+
+        if not missed:
+            return resp
+
+        # Read the adapters for the LPARs that missed.
+        lpar_cnas = utils.list_cnas_by_lpar(self.adapter, self.host_uuid,
+                                            lpar_uuids=list(missed.keys()))
+        for lpar_uuid, cna_wraps in lpar_cnas.items():
+            self.update(lpar_uuid, cna_wraps)
+            for mac in missed[lpar_uuid]:
+                cna = self._index[lpar_uuid].get(self._mac_key(mac))
+                if cna is not None:
+                    resp[(lpar_uuid, mac)] = cna
         return resp
 
+    @property
+    def stats(self):
+        """Returns the size and hit/miss counts of the index."""
+        return {'lpars': len(self._index), 'hits': self.hits,
+                'misses': self.misses}
+
 
 class UpdateVLANRequest(object):
     """Used for the async update of the PVIDs on ports."""
@@ -163,7 +437,7 @@ class UpdateVLANRequest(object):
                       the VLAN on.
         """
         self.p_req = p_req
-        self.attempt_count = 0
+        self.deadline = time.time() + ACONF.pvid_update_timeout
 
 
 class PVIDLooper(object):
@@ -174,22 +448,44 @@ class PVIDLooper(object):
     done before the CNA actually exists.
 
     This class will listen for a period of time, and when the CNA becomes
-    available, will update the CNA with the appropriate PVID.
+    available, will update the CNA with the appropriate PVID.  It is woken
+    by the CNAEventHandler when the LPAR of a pending request changes, and
+    otherwise polls with an exponential back off.  When there are no pending
+    requests, it sleeps until a request is added.
     """
 
+    # The bounds (in seconds) of the poll interval while requests are pending.
+    MIN_POLL_INTERVAL = 0.5
+    MAX_POLL_INTERVAL = 16
+
     def __init__(self, agent):
         """Initializes the looper.
 
         :param agent: The agent running the PVIDLooper
         """
-        self.requests = []
+        # The pending requests, keyed by their (LPAR UUID, MAC address).
+        # The number of pending requests per VLAN and per LPAR are kept
+        # alongside them.
+        self.requests = {}
+        self._vlan_counts = collections.Counter()
+        self._lpar_counts = collections.Counter()
         self.agent = agent
         self.adapter = agent.adapter
         self.host_uuid = agent.host_uuid
+        self._wakeup = threading.Event()
+
+    def wake(self, lpar_uuid=None):
+        """Wakes the looper to make a pass over the pending requests.
+
+        :param lpar_uuid: (Optional) The LPAR that has changed.  If there are
+                          no pending requests for it, the looper is not woken.
+        """
+        if lpar_uuid is None or self._lpar_counts[lpar_uuid] > 0:
+            self._wakeup.set()
 
     def update(self):
         """Performs a loop and updates all of the queued requests."""
-        current_requests = copy.copy(self.requests)
+        current_requests = list(self.requests.values())
 
         # No requests, do nothing.
         if len(current_requests) == 0:
@@ -198,32 +494,48 @@ class PVIDLooper(object):
         # Get the lpar UUIDs up front.
         lpar_uuids = utils.list_lpar_uuids(self.adapter, self.host_uuid)
 
+        # Find the adapters for the requests whose LPAR is on the system.
+        # The adapters not yet known to the agent are read with one request
+        # per LPAR (no matter how many of its adapters are pending), and the
+        # LPARs are read concurrently.
+        keys = {(x.p_req.lpar_uuid, x.p_req.mac_address)
+                for x in current_requests if x.p_req.lpar_uuid in lpar_uuids}
+        try:
+            cnas = self.agent.cna_index.find_many(keys) if keys else {}
+        except Exception as e:
+            LOG.warn(_LW("An error occurred while attempting to find the "
+                         "virtual NICs to update the PVIDs of."))
+            LOG.exception(e)
+            cnas = {}
+
         # Loop through the current requests.  Try to update the PVIDs, but
         # if we are unable, then increment the attempt count.
         for request in current_requests:
-            self._update_req(request, lpar_uuids)
+            self._update_req(request, lpar_uuids, cnas)
 
-    def _update_req(self, request, lpar_uuids):
+    def _update_req(self, request, lpar_uuids, cnas):
         """Attempts to provision a given UpdateVLANRequest.
 
         :param request: The UpdateVLANRequest.
+        :param lpar_uuids: The UUIDs of the LPARs on the system.
+        :param cnas: A dictionary of the (LPAR UUID, MAC address) of the
+                     requests to the CNA wrapper, for the CNAs that were found.
         :return: True if the request was successfully processed.  False if it
                  was not able to process.
         """
         # Pull the ProvisionRequest off the VLAN Update call.
         p_req = request.p_req
-        client_adpts = []
 
         try:
             if p_req.lpar_uuid in lpar_uuids:
-                # Get the adapters just for the VM that the request is for.
-                client_adpts = utils.list_cnas(self.adapter, self.host_uuid,
-                                               lpar_uuid=p_req.lpar_uuid)
-                cna = utils.find_cna_for_mac(p_req.mac_address, client_adpts)
+                cna = cnas.get((p_req.lpar_uuid, p_req.mac_address))
                 if cna:
-                    # If the PVID does not match, update the CNA.
+                    # If the PVID does not match, update the CNA.  The
+                    # index keeps the updated wrapper, with its new etag.
                     if cna.pvid != p_req.segmentation_id:
-                        utils.update_cna_pvid(cna, p_req.segmentation_id)
+                        cna = utils.update_cna_pvid(cna,
+                                                    p_req.segmentation_id)
+                        self.agent.cna_index.put(p_req.lpar_uuid, cna)
                     LOG.info(_LI("Sending update device for %s"),
                              p_req.mac_address)
                     self.agent.update_device_up(p_req.rpc_device)
@@ -234,13 +546,15 @@ class PVIDLooper(object):
             LOG.warn(_LW("An error occurred while attempting to update the "
                          "PVID of the virtual NIC."))
             LOG.exception(e)
+            # The indexed adapters may be stale.  Read them on the next try.
+            self.agent.cna_index.remove(p_req.lpar_uuid)
 
-        # Increment the request count.
-        request.attempt_count += 1
-        if request.attempt_count >= ACONF.pvid_update_loops:
+        # Give up on the request once its deadline passes.
+        if time.time() >= request.deadline:
             # If it had been on the system...this is an error.
             if p_req.lpar_uuid in lpar_uuids:
-                self._mark_failed(p_req, client_adpts)
+                self._mark_failed(
+                    p_req, self.agent.cna_index.list_cnas(p_req.lpar_uuid))
 
             # Remove the request from the overall queue
             self._remove_request(request)
@@ -265,6 +579,7 @@ class PVIDLooper(object):
 
     def looping_call(self):
         """Runs the update method, but wraps a try/except block around it."""
+        interval = self.MIN_POLL_INTERVAL
         while True:
             try:
                 self.update()
@@ -272,12 +587,47 @@ class PVIDLooper(object):
                 # Only log the exception, do not block the processing.
                 LOG.exception(e)
 
-            # Sleep for a second.
-            time.sleep(1)
+            interval = self._wait(interval)
+
+    def _wait(self, interval):
+        """Waits for the next pass of the looper.
+
+        :param interval: The poll interval to wait, if there are pending
+                         requests.
+        :return: The poll interval for the next wait.
+        """
+        if not self.requests:
+            # Nothing to do until a request is added.
+            self._wakeup.wait()
+            woken = True
+        else:
+            # Don't sleep past the earliest deadline.
+            deadline = min(x.deadline for x in self.requests.values())
+            timeout = max(min(interval, deadline - time.time()), 0)
+            woken = self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+        if woken:
+            return self.MIN_POLL_INTERVAL
+        return min(interval * 2, self.MAX_POLL_INTERVAL)
+
+    @staticmethod
+    def _key(request):
+        return request.p_req.lpar_uuid, request.p_req.mac_address
+
+    @staticmethod
+    def _decrement(counter, key):
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
 
     @lockutils.synchronized('pvid_looper_req')
     def _remove_request(self, request):
-        self.requests.remove(request)
+        key = self._key(request)
+        if self.requests.get(key) is request:
+            del self.requests[key]
+            self._decrement(self._vlan_counts, request.p_req.segmentation_id)
+            self._decrement(self._lpar_counts, request.p_req.lpar_uuid)
 
     @lockutils.synchronized('pvid_looper_req')
     def add(self, request):
@@ -290,16 +640,13 @@ class PVIDLooper(object):
         # invalidates...thus making it appear like the request came through
         # a few times.
         #
-        # We should look at the existing queue, and only add to it if we do
-        # not have one with a similar to it.
-        contains = False
-        for existing_req in self.requests:
-            if existing_req.p_req == request.p_req:
-                contains = True
-                break
-
-        if not contains:
-            self.requests.append(request)
+        # Only add it if we do not have one for the same LPAR and MAC.
+        key = self._key(request)
+        if key not in self.requests:
+            self.requests[key] = request
+            self._vlan_counts[request.p_req.segmentation_id] += 1
+            self._lpar_counts[request.p_req.lpar_uuid] += 1
+            self._wakeup.set()
 
     @property
     @lockutils.synchronized('pvid_looper_req')
@@ -308,7 +655,184 @@ class PVIDLooper(object):
 
         :return: Set of unique VLAN ids from within the pending requests.
         """
-        return {x.p_req.segmentation_id for x in self.requests}
+        return set(self._vlan_counts)
+
+
+class NBWrite(object):
+    """A change to the VLANs on a network bridge, queued for its writer."""
+
+    def __init__(self, add_vlans=None, remove_vlans=None, callback=None):
+        """Creates the write.
+
+        :param add_vlans: (Optional) The VLANs to add to the network bridge.
+        :param remove_vlans: (Optional) The VLANs to remove from the network
+                             bridge.
+        :param callback: (Optional) Called once the write has been made.  It
+                         is passed None, or the exception if the write
+                         failed.
+        """
+        self.add_vlans = set(add_vlans or [])
+        self.remove_vlans = set(remove_vlans or [])
+        self.callback = callback
+        self.queued = time.time()
+        self._done = event.Event()
+
+    def wait(self):
+        """Waits for the write to be made.  Raises its error if it failed."""
+        self._done.wait()
+
+    def finish(self, exc=None):
+        """Completes the write, and wakes those waiting on it.
+
+        :param exc: (Optional) The exception if the write failed.
+        """
+        if self._done.ready():
+            return
+        if self.callback is not None:
+            try:
+                self.callback(exc)
+            except Exception as e:
+                LOG.exception(e)
+        if exc is None:
+            self._done.send()
+        else:
+            self._done.send_exception(exc)
+
+
+class NBWriteQueue(object):
+    """Serializes and merges the VLAN writes to the network bridges.
+
+    Both the provisioning and the heal change the VLANs on the network
+    bridges.  Rather than each of them reading and updating the bridge (and
+    racing each other on its etag), they queue their changes here.  Each
+    bridge has a single writer, which gathers the changes for a short window
+    and then makes them together: one ensure for all of the VLANs added, and
+    then one removal for all of the VLANs removed.  So a window makes at
+    most two updates of the bridge.
+
+    A VLAN that is both added and removed within the window is kept, as is
+    any VLAN that the agent is still provisioning when the removal is made.
+    """
+
+    def __init__(self, agent):
+        """Creates the queue.
+
+        :param agent: The agent whose network bridges are written to.
+        """
+        self.agent = agent
+        # The writes waiting for each network bridge's writer, and the
+        # bridges that have a writer running.
+        self._pending = {}
+        self._writers = set()
+
+        # Metrics.  The merge ratio is the number of writes made per pass of
+        # a writer.  The updates count the ensures and removals made, each
+        # a single update of the bridge.
+        self.written = 0
+        self.batches = 0
+        self.updates = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add_vlans(self, nb_uuid, vlans, callback=None):
+        """Queues VLANs to be added to a network bridge.
+
+        :param nb_uuid: The UUID of the network bridge.
+        :param vlans: The VLANs to add.
+        :param callback: (Optional) Called with None once the VLANs are on
+                         the bridge, or with the exception if they could not
+                         be added.
+        :return: The NBWrite, which may be waited on.
+        """
+        return self._queue(nb_uuid, NBWrite(add_vlans=vlans,
+                                            callback=callback))
+
+    def remove_vlans(self, nb_uuid, vlans):
+        """Queues VLANs to be removed from a network bridge.
+
+        :param nb_uuid: The UUID of the network bridge.
+        :param vlans: The VLANs to remove.
+        :return: The NBWrite, which may be waited on.
+        """
+        return self._queue(nb_uuid, NBWrite(remove_vlans=vlans))
+
+    def _queue(self, nb_uuid, write):
+        self._pending.setdefault(nb_uuid, []).append(write)
+        if nb_uuid not in self._writers:
+            self._writers.add(nb_uuid)
+            eventlet.spawn_n(self._writer, nb_uuid)
+        return write
+
+    def _writer(self, nb_uuid):
+        """Makes the writes to a network bridge until there are none left."""
+        writes = []
+        try:
+            while True:
+                eventlet.sleep(ACONF.nb_write_window_ms / 1000.0)
+                writes = self._pending.pop(nb_uuid, [])
+                if not writes:
+                    return
+                self._write(nb_uuid, writes)
+                writes = []
+        except Exception as e:
+            LOG.exception(e)
+            # Fail the writes in hand, and those still pending, so that
+            # nothing waits on them forever.
+            for write in writes + self._pending.pop(nb_uuid, []):
+                write.finish(e)
+        finally:
+            self._writers.discard(nb_uuid)
+
+    def _write(self, nb_uuid, writes):
+        """Merges a set of writes into a single pass over the bridge."""
+        adds = set().union(*[x.add_vlans for x in writes])
+        removes = set().union(*[x.remove_vlans for x in writes])
+        removes -= adds | self.agent.vlans_in_flight(nb_uuid)
+
+        add_exc = remove_exc = None
+        if adds:
+            try:
+                net_br.ensure_vlans_on_nb(self.agent.adapter,
+                                          self.agent.host_uuid, nb_uuid,
+                                          adds)
+                self.updates += 1
+            except Exception as e:
+                add_exc = e
+
+        if removes:
+            try:
+                utils.remove_vlans_from_nb(self.agent.adapter,
+                                           self.agent.host_uuid, nb_uuid,
+                                           sorted(removes))
+                self.updates += 1
+            except Exception as e:
+                remove_exc = e
+
+        if adds or removes:
+            self.agent.topology.invalidate_bridges()
+
+        self.batches += 1
+        now = time.time()
+        for write in writes:
+            latency = now - write.queued
+            self.written += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            exc = add_exc if write.add_vlans else None
+            if exc is None and write.remove_vlans:
+                exc = remove_exc
+            write.finish(exc)
+
+    @property
+    def stats(self):
+        """Returns the merge ratio and latency metrics of the writes."""
+        merge_ratio = (float(self.written) / self.batches
+                       if self.batches else 0.0)
+        avg = self.total_latency / self.written if self.written else 0.0
+        return {'pending': sum(len(x) for x in self._pending.values()),
+                'written': self.written, 'batches': self.batches,
+                'updates': self.updates, 'merge_ratio': merge_ratio,
+                'avg_latency': avg, 'max_latency': self.max_latency}
 
 
 class SharedEthernetNeutronAgent(agent_base.BasePVMNeutronAgent):
@@ -327,6 +851,31 @@ class SharedEthernetNeutronAgent(agent_base.BasePVMNeutronAgent):
         self.br_map = utils.parse_sea_mappings(self.adapter, self.host_uuid,
                                                ACONF.bridge_mappings)
 
+        # An index of the Client Network Adapters (CNAs) on the system.  Kept
+        # current by the CNAEventHandler.
+        self.cna_index = CNAIndex(self.adapter, self.host_uuid)
+
+        # The NetworkBridges and VirtualSwitches on the system.  The
+        # CNAEventHandler invalidates them as the events come in.
+        self.topology = utils.TopologyCache(self.adapter, self.host_uuid)
+
+        # The VLANs provisioned on each NetworkBridge, to the time they were
+        # written to the bridge (None while the write is queued).  A heal
+        # forgets those written before it began.
+        self._provisioned_vlans = collections.defaultdict(dict)
+
+        # All of the writes to the NetworkBridges go through a single writer
+        # per bridge.
+        self.nb_writer = NBWriteQueue(self)
+
+        # What has changed since the last heal.  The heal only looks at the
+        # dirty LPARs and network bridges, apart from a periodic full sweep.
+        self._dirty_lpars = set()
+        self._dirty_nbs = set()
+        self._topology_dirty = False
+        self._full_heal_needed = True
+        self._last_full_heal = 0
+
         # A looping utility that updates asynchronously the PVIDs on the
         # Client Network Adapters (CNAs)
         self.pvid_updater = PVIDLooper(self)
@@ -363,24 +912,104 @@ class SharedEthernetNeutronAgent(agent_base.BasePVMNeutronAgent):
            managed or not.
          - Are not part of the primary load group on the Network Bridge.
 
+        The heal works from a snapshot of the system taken as it begins, and
+        may run alongside the provisioning of new ports.  The writes to each
+        network bridge go through the same writer that the provisioning
+        uses, and the VLANs provisioned since the snapshot are never removed.
+
         :param is_boot: Indicates if this is the first call on boot up of the
                         agent.
         """
-        # List all our clients
-        client_adpts = utils.list_cnas(self.adapter, self.host_uuid)
+        full = (is_boot or self._full_heal_needed or
+                time.time() - self._last_full_heal >=
+                ACONF.heal_full_sweep_interval)
+        dirty_lpars, self._dirty_lpars = self._dirty_lpars, set()
+        dirty_nbs, self._dirty_nbs = self._dirty_nbs, set()
+        topology_dirty, self._topology_dirty = self._topology_dirty, False
+        if not (full or dirty_lpars or dirty_nbs or topology_dirty):
+            LOG.debug("Nothing has changed since the last heal.")
+            return
 
-        # Get all the devices that Neutron knows for this host.  Note that
-        # we pass in all of the macs on the system.  For VMs that neutron does
-        # not know about, we get back an empty structure with just the mac.
-        client_macs = [utils.norm_mac(x.mac) for x in client_adpts]
-        devs = self.get_devices_details_list(client_macs)
+        try:
+            self._heal_and_optimize(is_boot, full, dirty_lpars, dirty_nbs,
+                                    topology_dirty)
+        except Exception:
+            # Look at everything again on the next heal.
+            self._dirty_lpars |= dirty_lpars
+            self._dirty_nbs |= dirty_nbs
+            self._topology_dirty |= topology_dirty
+            self._full_heal_needed |= full
+            raise
+
+    def _heal_and_optimize(self, is_boot, full, dirty_lpars, dirty_nbs,
+                           topology_dirty):
+        """Performs the heal, for the parts of the system that changed.
+
+        :param is_boot: Indicates if this is the first call on boot up of the
+                        agent.
+        :param full: If True, the whole system is healed.
+        :param dirty_lpars: The UUIDs of the LPARs that have changed.
+        :param dirty_nbs: The UUIDs of the network bridges that have changed.
+        :param topology_dirty: If True, any of the network bridges may have
+                               changed.
+        """
+        start = time.time()
+
+        # We will have a list of CNAs that are not yet created, but are pending
+        # provisioning from Nova.  Keep track of those so that we don't tear
+        # those off the SEA.
+        pending_vlans = self.pvid_updater.pending_vlans
+
+        # List all our clients.  A full heal reads them all, otherwise only
+        # those of the changed LPARs are read and the rest come from the
+        # index.
+        dirty_macs = set()
+        if full:
+            self.cna_index.reset(
+                utils.list_cnas_by_lpar(self.adapter, self.host_uuid))
+            self._full_heal_needed = False
+            self._last_full_heal = time.time()
+        elif dirty_lpars:
+            lpar_cnas = utils.list_cnas_by_lpar(
+                self.adapter, self.host_uuid, lpar_uuids=list(dirty_lpars))
+            for lpar_uuid, cna_wraps in lpar_cnas.items():
+                dirty_macs.update(utils.norm_mac(x.mac) for x in cna_wraps)
+                if cna_wraps:
+                    self.cna_index.update(lpar_uuid, cna_wraps)
+                else:
+                    self.cna_index.remove(lpar_uuid)
+        client_adpts = self.cna_index.all_cnas()
+
+        # On boot, make sure the topology is read fresh.
+        if is_boot:
+            self.topology.invalidate()
 
         # Dictionary of the required VLANs on the Network Bridge
         nb_req_vlans = {}
-        nb_wraps = utils.list_bridges(self.adapter, self.host_uuid)
+        nb_wraps = self.topology.list_bridges()
+        nb_vlan_map = self.topology.get_nb_vlan_map()
         for nb_wrap in nb_wraps:
             nb_req_vlans[nb_wrap.uuid] = set()
 
+        # The network bridges to ensure the VLANs on.  If the bridges are
+        # unchanged, only the VLANs of the changed LPARs need to be ensured.
+        if full or topology_dirty:
+            ensure_nbs = set(nb_req_vlans.keys())
+        else:
+            ensure_nbs = dirty_nbs & set(nb_req_vlans.keys())
+        if full or ensure_nbs:
+            client_macs = [utils.norm_mac(x.mac) for x in client_adpts]
+        else:
+            client_macs = list(dirty_macs)
+
+        # Get all the devices that Neutron knows for this host.  Note that
+        # we pass in all of the macs on the system (or of the changed LPARs).
+        # For VMs that neutron does not know about, we get back an empty
+        # structure with just the mac.
+        devs = []
+        if client_macs:
+            devs = self.get_devices_details_list(client_macs)
+
         for dev in devs:
             nb_uuid, req_vlan = self._get_nb_and_vlan(dev, emit_warnings=False)
 
@@ -391,12 +1020,27 @@ class SharedEthernetNeutronAgent(agent_base.BasePVMNeutronAgent):
 
             # If that list does not contain my VLAN, add it
             nb_req_vlans[nb_uuid].add(req_vlan)
+            if dev.get('device') in dirty_macs:
+                ensure_nbs.add(nb_uuid)
 
         # Lets ensure that all VLANs for the openstack VMs are on the network
-        # bridges.
-        for nb_uuid in nb_req_vlans.keys():
-            net_br.ensure_vlans_on_nb(self.adapter, self.host_uuid, nb_uuid,
-                                      nb_req_vlans[nb_uuid])
+        # bridges.  The bridges that already have all their VLANs (as of the
+        # snapshot) are not written to.
+        nb_map = {nb.uuid: nb for nb in nb_wraps}
+        writes = []
+        skips = 0
+        for nb_uuid in ensure_nbs:
+            missing_vlans = (nb_req_vlans[nb_uuid] -
+                             set(nb_map[nb_uuid].list_vlans()))
+            if not missing_vlans:
+                skips += 1
+                continue
+            writes.append(self.nb_writer.add_vlans(nb_uuid, missing_vlans))
+        for write in writes:
+            write.wait()
+        LOG.debug("Network bridge writes during the heal: %(writes)d made, "
+                  "%(skips)d skipped as the VLANs were already there.",
+                  {'writes': len(writes), 'skips': skips})
 
         # We should clean up old VLANs as well.  However, we only want to clean
         # up old VLANs that are not in use by ANYTHING in the system.
@@ -407,9 +1051,9 @@ class SharedEthernetNeutronAgent(agent_base.BasePVMNeutronAgent):
         # We first extend that map by listing all the VMs on the system
         # (whether managed by OpenStack or not) and then seeing what Network
         # Bridge uses them.
-        vswitch_map = utils.get_vswitch_map(self.adapter, self.host_uuid)
         for client_adpt in client_adpts:
-            nb = utils.find_nb_for_cna(nb_wraps, client_adpt, vswitch_map)
+            nb = nb_vlan_map.get((client_adpt.vswitch_uri,
+                                  int(client_adpt.pvid)))
             # Could occur if a system is internal only.
             if nb is None:
                 LOG.debug("Client Adapter with mac %s is internal only.",
@@ -424,11 +1068,6 @@ class SharedEthernetNeutronAgent(agent_base.BasePVMNeutronAgent):
             for addl_vlan in client_adpt.tagged_vlans:
                 nb_req_vlans[nb.uuid].add(addl_vlan)
 
-        # We will have a list of CNAs that are not yet created, but are pending
-        # provisioning from Nova.  Keep track of those so that we don't tear
-        # those off the SEA.
-        pending_vlans = self.pvid_updater.pending_vlans
-
         # The list of required VLANs on each network bridge also includes
         # everything on the primary VEA.
         for nb in nb_wraps:
@@ -438,46 +1077,116 @@ class SharedEthernetNeutronAgent(agent_base.BasePVMNeutronAgent):
             for vlan in vlans:
                 nb_req_vlans[nb.uuid].add(vlan)
 
-        # If the configuration is set.
-        if ACONF.automated_powervm_vlan_cleanup:
+        # If the configuration is set.  Only a full heal knows the VLANs that
+        # all the ports need, so the incremental heals leave the VLANs be.
+        if ACONF.automated_powervm_vlan_cleanup and full:
             # Loop through and remove VLANs that are no longer needed.
-            for nb in nb_wraps:
-                # Join the required vlans on the network bridge (already in
-                # use) with the pending VLANs.
-                req_vlans = nb_req_vlans[nb.uuid] | pending_vlans
-
-                # Get ALL the VLANs on the bridge
-                existing_vlans = set(nb.list_vlans())
-
-                # To determine the ones no longer needed, subtract from all the
-                # VLANs the ones that are no longer needed.
-                vlans_to_del = existing_vlans - req_vlans
-                for vlan_to_del in vlans_to_del:
-                    LOG.warn(_LW("Cleaning up VLAN %(vlan)s from the system.  "
-                                 "It is no longer in use."),
-                             {'vlan': vlan_to_del})
-                    net_br.remove_vlan_from_nb(self.adapter, self.host_uuid,
-                                               nb.uuid, vlan_to_del)
+            writes = [self._remove_unused_vlans(nb, nb_req_vlans[nb.uuid],
+                                                pending_vlans)
+                      for nb in nb_wraps]
+            for write in writes:
+                if write is not None:
+                    write.wait()
+
+        LOG.debug("Healed %(scope)s: %(lpars)d changed LPARs and %(nbs)d "
+                  "network bridges ensured.",
+                  {'scope': 'fully' if full else 'incrementally',
+                   'lpars': len(dirty_lpars), 'nbs': len(ensure_nbs)})
+        LOG.debug("Topology cache statistics: %s", self.topology.stats)
+        LOG.debug("Feed cache statistics: %s", utils.feed_cache_stats())
+        LOG.debug("Unknown MAC cache statistics: %s", self.unknown_macs.stats)
+        LOG.debug("Network bridge write statistics: %s", self.nb_writer.stats)
+
+        # The VLANs written before the heal began were pending a PVID update,
+        # or on their adapters, as of its snapshot.  So this heal kept them,
+        # and the next one will too.
+        for vlans in self._provisioned_vlans.values():
+            for vlan, written in list(vlans.items()):
+                if written is not None and written < start:
+                    del vlans[vlan]
+
+    def mark_lpar_dirty(self, lpar_uuid):
+        """Indicates that an LPAR has changed since the last heal."""
+        self._dirty_lpars.add(lpar_uuid)
+
+    def mark_topology_dirty(self):
+        """Indicates the network bridges may have changed since the last heal.
+        """
+        self._topology_dirty = True
+
+    def request_full_heal(self):
+        """Makes the next heal a full heal of the system."""
+        self._full_heal_needed = True
+
+    def _remove_unused_vlans(self, nb, req_vlans, pending_vlans):
+        """Queues the removal of the VLANs that are no longer needed.
+
+        :param nb: The NetworkBridge wrapper, from the heal's snapshot.
+        :param req_vlans: The VLANs in use on the network bridge.
+        :param pending_vlans: The VLANs pending a PVID update, from the
+                              heal's snapshot.
+        :return: The NBWrite for the removal, or None if there is nothing to
+                 remove.
+        """
+        # Join the required vlans on the network bridge (already in use) with
+        # the pending VLANs, as of the snapshot and now.  Any VLAN provisioned
+        # since the snapshot is also required.
+        req_vlans = req_vlans | pending_vlans | self.vlans_in_flight(nb.uuid)
+
+        # Get ALL the VLANs on the bridge
+        existing_vlans = set(nb.list_vlans())
+
+        # To determine the ones no longer needed, subtract from all the
+        # VLANs the ones that are no longer needed.
+        vlans_to_del = sorted(existing_vlans - req_vlans)
+        if not vlans_to_del:
+            return None
+
+        # Only a batch is removed on each heal.  The next heal, which is a
+        # full heal, removes the rest.
+        batch_size = ACONF.vlan_cleanup_batch_size
+        if len(vlans_to_del) > batch_size:
+            vlans_to_del = vlans_to_del[:batch_size]
+            self.request_full_heal()
+
+        LOG.warn(_LW("Cleaning up VLANs %(vlans)s from the system.  They are "
+                     "no longer in use."), {'vlans': vlans_to_del})
+        return self.nb_writer.remove_vlans(nb.uuid, vlans_to_del)
+
+    def vlans_in_flight(self, nb_uuid):
+        """Returns the VLANs being provisioned on a network bridge.
+
+        These are the VLANs provisioned that the current heal may not have
+        seen, and those pending a PVID update.  They must not be removed
+        from the bridge.
+
+        :param nb_uuid: The UUID of the network bridge.
+        """
+        return (self.pvid_updater.pending_vlans |
+                set(self._provisioned_vlans[nb_uuid]))
 
     def provision_devices(self, requests):
         """Will ensure that the VLANs are on the NBs for the edge devices.
 
         Takes in a set of ProvisionRequests.  From those devices, determines
-        the correct network bridges and their appropriate VLANs.  Then calls
-        down to the pypowervm API to ensure that the required VLANs are
-        on the appropriate ports.
+        the correct network bridges and their appropriate VLANs.  Then queues
+        the required VLANs to the writers of the appropriate bridges, and
+        returns without waiting for them.
 
-        Will also ensure that the client side adapter is updated with the
-        correct VLAN.
+        Once the VLANs are on the bridge, will also ensure that the client
+        side adapter is updated with the correct VLAN.  If the VLANs can not
+        be added, the devices are set down.
 
         :param requests: A list of ProvisionRequest objects.
         """
         nb_to_vlan = {}
+        nb_to_reqs = {}
         for p_req in requests:
             # Break the ports into their respective lists broken down by
             # Network Bridge.
             nb_uuid, vlan = self._get_nb_and_vlan(p_req.rpc_device,
                                                   emit_warnings=True)
+            nb_to_reqs.setdefault(nb_uuid, []).append(p_req)
 
             # A warning message will be printed to user if this were to occur
             if nb_uuid is None:
@@ -488,18 +1197,52 @@ class SharedEthernetNeutronAgent(agent_base.BasePVMNeutronAgent):
 
             nb_to_vlan[nb_uuid].add(vlan)
 
-        # For each bridge, make sure the VLANs are serviced.
-        for nb_uuid in nb_to_vlan.keys():
-            net_br.ensure_vlans_on_nb(self.adapter, self.host_uuid, nb_uuid,
-                                      nb_to_vlan.get(nb_uuid))
+        # For each bridge, queue the VLANs to be added.  Once they are on the
+        # bridge, the PVID update on the client devices is kicked off.  This
+        # should not be done until the vlan is on the network bridge.
+        # Otherwise the port state in the backing neutron server could be out
+        # of sync.  The VLANs are recorded as provisioned first, so that a
+        # heal running alongside does not remove them.
+        for nb_uuid, vlans in nb_to_vlan.items():
+            self._provisioned_vlans[nb_uuid].update(
+                dict.fromkeys(vlans, None))
+            self._dirty_nbs.add(nb_uuid)
+            self.nb_writer.add_vlans(
+                nb_uuid, vlans,
+                callback=functools.partial(self._nb_provisioned, nb_uuid,
+                                           vlans, nb_to_reqs[nb_uuid],
+                                           time.time()))
+
+        for p_req in nb_to_reqs.get(None, []):
+            self.pvid_updater.add(UpdateVLANRequest(p_req))
+        LOG.debug('Queued the provisioning of new devices.')
 
-        # Now that the bridging is complete, loop through the devices again
-        # and kick off the PVID update on the client devices.  This should
-        # not be done until the vlan is on the network bridge.  Otherwise the
-        # port state in the backing neutron server could be out of sync.
-        for p_req in requests:
+    def _nb_provisioned(self, nb_uuid, vlans, p_reqs, start, exc):
+        """Invoked once the VLANs for a set of requests are on the bridge.
+
+        :param nb_uuid: The UUID of the network bridge.
+        :param vlans: The set of VLANs added to the bridge.
+        :param p_reqs: The ProvisionRequests for the bridge.
+        :param start: The time at which the VLANs were queued.
+        :param exc: The exception, if the VLANs could not be added.  The
+                    requests are then set down.
+        """
+        # Only now can a heal's snapshot see the VLANs as pending.
+        written = time.time()
+        for vlan in vlans:
+            self._provisioned_vlans[nb_uuid][vlan] = written
+
+        if exc is not None:
+            LOG.error(_LE("Unable to provision VLANs %(vlans)s on network "
+                          "bridge %(nb)s: %(exc)s"),
+                      {'vlans': list(vlans), 'nb': nb_uuid, 'exc': exc})
+            for p_req in p_reqs:
+                self.update_device_down(p_req.rpc_device)
+            return
+
+        self.record_provision_latency(start)
+        for p_req in p_reqs:
             self.pvid_updater.add(UpdateVLANRequest(p_req))
-        LOG.debug('Successfully provisioned new devices.')
 
     def _get_nb_and_vlan(self, dev, emit_warnings=False):
         """Parses bridge mappings to find a match for the device passed in.
@@ -14,8 +14,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import functools
+
+from eventlet import greenpool
 from oslo_log import log as logging
 
+from pypowervm import const as pvm_const
 from pypowervm import exceptions as pvm_exc
 from pypowervm.helpers import log_helper as pvm_log
 from pypowervm import util as pvm_util
@@ -32,6 +37,20 @@ LOG = logging.getLogger(__name__)
 
 """Provides a set of utilities for API interaction and Neutron."""
 
+# The maximum number of concurrent REST reads used when gathering the Client
+# Network Adapters across many LPARs.
+CNA_READ_CONCURRENCY = 8
+
+# The maximum number of feeds whose etag and wrappers are remembered for
+# conditional reads.  There is a feed per LPAR, so this should be well above
+# the number of LPARs a system can hold.
+FEED_CACHE_SIZE = 2048
+
+# The feed key (see _read_feed) to the (etag, wrappers) of its last read, in
+# least recently used order.
+_FEED_CACHE = collections.OrderedDict()
+_FEED_STATS = {'modified': 0, 'not_modified': 0}
+
 
 def get_host_uuid(adapter):
     """Get the System wrapper and its UUID for the (single) host.
@@ -77,11 +96,7 @@ def parse_sea_mappings(adapter, host_uuid, mapping):
         return _parse_empty_bridge_mapping(nb_wraps)
 
     # Need to find a list of all the VIOSes names to hrefs
-    vio_feed = adapter.read(pvm_ms.System.schema_type,
-                            root_id=host_uuid,
-                            child_type=pvm_vios.VIOS.schema_type,
-                            xag=[pvm_vios.VIOS.xags.NETWORK])
-    vio_wraps = pvm_vios.VIOS.wrap(vio_feed)
+    vio_wraps = list_vioses(adapter, host_uuid)
 
     # Response dictionary
     resp = {}
@@ -162,52 +177,28 @@ def norm_mac(mac):
     return ':'.join(mac[i:i + 2] for i in range(0, len(mac), 2))
 
 
-def find_cna_for_mac(mac, client_adpts):
-    """Returns the appropriate client adapter for a given mac address.
-
-    :param mac: The mac address of the client adapter.
-    :param client_adpts: The Client Adapters from pypowervm.
-    :returns: The Client Adapter for the mac.  If one isn't found, then
-              None will be returned.
-    """
-    mac = pvm_util.sanitize_mac_for_api(mac)
+def build_nb_vlan_map(nb_wraps, vswitch_map):
+    """Builds a lookup table for the NetworkBridge supporting a VLAN.
 
-    for client_adpt in client_adpts:
-        if client_adpt.mac == mac:
-            return client_adpt
+    The table is built once for a set of network bridges, so that finding
+    the bridge of each client adapter is a single dictionary lookup rather
+    than a walk of every network bridge.
 
-    # None was found.
-    return None
-
-
-def find_nb_for_cna(nb_wraps, client_adpt, vswitch_map):
-    """
-    Determines the NetworkBridge (if any) that is supporting a client
-    adapter.
+    Ex. {('https://.../VirtualSwitch/<UUID>', 1234): <NetBridge wrapper>}
 
     :param nb_wraps: The network bridge wrappers on the system.
-    :param client_adpt: The client adapter wrapper.
     :param vswitch_map: Maps the vSwitch IDs to URIs.
                         See 'get_vswitch_map'
-    :return The Network Bridge wrapper that is hosting the client adapter.
-            If there is not one, None is returned.
+    :return: A dictionary of the (vSwitch URI, VLAN) tuple to the Network
+             Bridge wrapper that is hosting it.
     """
+    resp = {}
     for nb_wrap in nb_wraps:
-        # If the vSwitch ID doesn't match the vSwitch on the CNA...don't
-        # process
-        if vswitch_map.get(nb_wrap.vswitch_id) != client_adpt.vswitch_uri:
-            continue
-
-        # If the VLAN is not on the network bridge, then do not process.
-        if not nb_wrap.supports_vlan(client_adpt.pvid):
-            continue
-
-        # At this point, the client adapter is supported by this network
-        # bridge
-        return nb_wrap
-
-    # No valid network bridge
-    return None
+        vswitch_uri = vswitch_map.get(nb_wrap.vswitch_id)
+        for vlan in nb_wrap.list_vlans():
+            # The first matching bridge wins.
+            resp.setdefault((vswitch_uri, int(vlan)), nb_wrap)
+    return resp
 
 
 @pvm_retry.retry()
@@ -219,9 +210,9 @@ def get_vswitch_map(adapter, host_uuid):
     :param adapter: The pypowervm adapter.
     :param host_uuid: The UUID for the host system.
     """
-    vsw_feed = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
-                            child_type=pvm_net.VSwitch.schema_type)
-    vswitches = pvm_net.VSwitch.wrap(vsw_feed)
+    vswitches = _read_feed(adapter, pvm_net.VSwitch.wrap,
+                           pvm_ms.System.schema_type, root_id=host_uuid,
+                           child_type=pvm_net.VSwitch.schema_type)
     resp = {}
     for vswitch in vswitches:
         resp[vswitch.switch_id] = vswitch.related_href
@@ -246,20 +237,45 @@ def list_cnas(adapter, host_uuid, lpar_uuid=None):
     :param lpar_uuid: (Optional) If specified, will only return the CNA's for
                       a given LPAR ID.
     """
-    # Get the UUIDs of the VMs to query for.
+    # A single VM is just a single read.
     if lpar_uuid:
-        vm_uuids = [lpar_uuid]
-    else:
-        vm_uuids = [x.uuid for x in _list_vm_entries(adapter, host_uuid)]
+        return _find_cnas(adapter, lpar_uuid)
 
-    # Loop through the VMs
+    # Flatten the per VM inventory
     total_cnas = []
-    for vm_uuid in vm_uuids:
-        total_cnas.extend(_find_cnas(adapter, vm_uuid))
+    for cna_wraps in list_cnas_by_lpar(adapter, host_uuid).values():
+        total_cnas.extend(cna_wraps)
 
     return total_cnas
 
 
+def list_cnas_by_lpar(adapter, host_uuid, lpar_uuids=None,
+                      concurrency=CNA_READ_CONCURRENCY):
+    """Lists the Client Network Adapters for a set of VMs, keyed by VM.
+
+    The API only exposes the ClientNetworkAdapters as children of each
+    LogicalPartition, there is no host level feed for them.  Rather than
+    reading each VM's adapters serially, the reads are spread across a bounded
+    pool of green threads.
+
+    :param adapter: The pypowervm adapter.
+    :param host_uuid: The UUID for the host system.
+    :param lpar_uuids: (Optional) The UUIDs of the VMs to query for.  If not
+                       specified, all of the client VMs on the system will be
+                       queried.
+    :param concurrency: (Optional) The maximum number of reads to have in
+                        flight at any one time.
+    :return: A dictionary of the VM UUID to the list of CNA wrappers for that
+             VM.  A VM that no longer exists maps to an empty list.
+    """
+    if lpar_uuids is None:
+        lpar_uuids = list_lpar_uuids(adapter, host_uuid)
+
+    pool = greenpool.GreenPool(size=concurrency)
+    cna_lists = pool.imap(functools.partial(_find_cnas, adapter), lpar_uuids)
+    return dict(zip(lpar_uuids, cna_lists))
+
+
 def _remove_log_helper(adapter):
     # Remove the log handler from the adapter so we don't log missing VMs
     # Pulling the helpers makes a copy
@@ -275,12 +291,9 @@ def _remove_log_helper(adapter):
 @pvm_retry.retry()
 def _find_cnas(adapter, vm_uuid):
     try:
-        # Extend the array to include the response
-        vm_cna_feed_resp = adapter.read(
-            pvm_lpar.LPAR.schema_type, root_id=vm_uuid,
-            child_type=pvm_net.CNA.schema_type,
-            helpers=_remove_log_helper(adapter))
-        return pvm_net.CNA.wrap(vm_cna_feed_resp)
+        return _read_feed(adapter, pvm_net.CNA.wrap, pvm_lpar.LPAR.schema_type,
+                          root_id=vm_uuid, child_type=pvm_net.CNA.schema_type,
+                          helpers=_remove_log_helper(adapter))
     except pvm_exc.HttpError as e:
         # If it is a 404 (not found) then just skip.
         if e.response is not None and e.response.status == 404:
@@ -289,6 +302,80 @@ def _find_cnas(adapter, vm_uuid):
             raise
 
 
+def _read_feed(adapter, wrap_func, root_type, root_id=None, child_type=None,
+               xag=None, helpers=None):
+    """Reads a feed, sending the etag of the last read of that feed.
+
+    If the API indicates (via a 304) that the feed has not changed since the
+    last read, the wrappers from that read are returned.  This avoids both the
+    transfer and the parsing of the feed.
+
+    The wrappers returned may be shared with other callers.  They should not
+    be modified unless the feed is invalidated.  See invalidate_feed_cache.
+
+    :param adapter: The pypowervm adapter.
+    :param wrap_func: The function that converts the Response into the
+                      wrappers.  Ex. pvm_net.NetBridge.wrap
+    :param root_type: The root type of the feed.
+    :param root_id: (Optional) The root UUID of the feed.
+    :param child_type: (Optional) The child type of the feed.
+    :param xag: (Optional) The extended attribute groups to read.
+    :param helpers: (Optional) The adapter helpers for the read.
+    :return: The list of wrappers for the feed.
+    """
+    key = (root_type, root_id, child_type, tuple(xag or ()))
+    cached = _FEED_CACHE.get(key)
+
+    kwargs = {'root_id': root_id, 'child_type': child_type,
+              'etag': cached[0] if cached else None}
+    if xag:
+        kwargs['xag'] = xag
+    if helpers is not None:
+        kwargs['helpers'] = helpers
+
+    try:
+        resp = adapter.read(root_type, **kwargs)
+    except pvm_exc.HttpError:
+        # Whatever was there before is gone (or unreadable), so forget it.
+        _FEED_CACHE.pop(key, None)
+        raise
+
+    if cached and resp.status == pvm_const.HTTPStatus.NO_CHANGE:
+        _FEED_STATS['not_modified'] += 1
+        # Move the feed to the most recently used end.  The read yields, so
+        # the feed may have been forgotten in the meantime.
+        _FEED_CACHE.pop(key, None)
+        _FEED_CACHE[key] = cached
+        return list(cached[1])
+
+    _FEED_STATS['modified'] += 1
+    wraps = wrap_func(resp)
+    _FEED_CACHE.pop(key, None)
+    if resp.etag:
+        _FEED_CACHE[key] = (resp.etag, list(wraps))
+        while len(_FEED_CACHE) > FEED_CACHE_SIZE:
+            _FEED_CACHE.popitem(last=False)
+    return wraps
+
+
+def invalidate_feed_cache(child_type=None):
+    """Forgets the etags and wrappers kept for conditional reads.
+
+    :param child_type: (Optional) If specified, only the feeds of this child
+                       type are forgotten.  Otherwise all are.
+    """
+    for key in list(_FEED_CACHE.keys()):
+        if child_type is None or key[2] == child_type:
+            _FEED_CACHE.pop(key, None)
+
+
+def feed_cache_stats():
+    """Returns the number of modified and not modified (304) feed reads."""
+    stats = dict(_FEED_STATS)
+    stats['feeds'] = len(_FEED_CACHE)
+    return stats
+
+
 @pvm_retry.retry()
 def _list_vm_entries(adapter, host_uuid):
     """
@@ -299,13 +386,11 @@ def _list_vm_entries(adapter, host_uuid):
     :param adapter: The pypowervm adapter.
     :param host_uuid: The UUID for the host system.
     """
-    vm_feed = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
-                           child_type=pvm_lpar.LPAR.schema_type)
-    vm_entries = vm_feed.feed.entries
-    vms = []
-    for vm_entry in vm_entries:
-        vms.append(pvm_lpar.LPAR.wrap(vm_entry))
-    return vms
+    def wrap_vms(vm_feed):
+        return [pvm_lpar.LPAR.wrap(x) for x in vm_feed.feed.entries]
+
+    return _read_feed(adapter, wrap_vms, pvm_ms.System.schema_type,
+                      root_id=host_uuid, child_type=pvm_lpar.LPAR.schema_type)
 
 
 @pvm_retry.retry()
@@ -317,9 +402,9 @@ def list_bridges(adapter, host_uuid):
     :param adapter: The pypowervm adapter.
     :param host_uuid: The UUID for the host system.
     """
-    resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
-                        child_type=pvm_net.NetBridge.schema_type)
-    net_bridges = pvm_net.NetBridge.wrap(resp)
+    net_bridges = _read_feed(adapter, pvm_net.NetBridge.wrap,
+                             pvm_ms.System.schema_type, root_id=host_uuid,
+                             child_type=pvm_net.NetBridge.schema_type)
 
     if len(net_bridges) == 0:
         LOG.warn(_LW('No NetworkBridges detected on the host.'))
@@ -327,6 +412,238 @@ def list_bridges(adapter, host_uuid):
     return net_bridges
 
 
+@pvm_retry.retry()
+def remove_vlans_from_nb(adapter, host_uuid, nb_uuid, vlan_ids):
+    """Removes a set of VLANs from a Network Bridge, in a single update.
+
+    Follows the rules of the network_bridger's remove_vlan_from_nb, but makes
+    just one read and one update of the Network Bridge (and so one
+    reconfiguration of the SEA) for all of the VLANs.  The VLANs on the
+    primary load group, the arbitrary PVIDs and the VLANs that are not on
+    the bridge are left alone.  A trunk adapter (or, with virtual networks,
+    a load group) that has all of its VLANs removed is removed too, unless
+    the load balancing of the bridge needs it.
+
+    :param adapter: The pypowervm adapter.
+    :param host_uuid: The UUID for the host system.
+    :param nb_uuid: The Network Bridge UUID.
+    :param vlan_ids: The VLAN identifiers to remove.
+    :return: The list of VLANs that were removed.
+    """
+    nb_wraps = pvm_net.NetBridge.wrap(adapter.read(
+        pvm_ms.System.schema_type, root_id=host_uuid,
+        child_type=pvm_net.NetBridge.schema_type))
+    nb = pvm_util.find_wrapper(nb_wraps, nb_uuid)
+
+    # Only the VLANs on the additional load groups can be removed.
+    prim_ld_grp = nb.load_grps[0]
+    vlans = set()
+    for vlan_id in (int(x) for x in vlan_ids):
+        if (vlan_id in nb.arbitrary_pvids or not nb.supports_vlan(vlan_id) or
+                vlan_id == prim_ld_grp.pvid or
+                vlan_id in prim_ld_grp.tagged_vlans or
+                len(nb.load_grps) == 1):
+            continue
+        vlans.add(vlan_id)
+    if not vlans:
+        return []
+
+    if adapter.traits.vnet_aware:
+        _strip_vlans_from_ld_grps(adapter, nb, vlans)
+    else:
+        _strip_vlans_from_trunks(nb, vlans)
+
+    nb.update()
+    return sorted(vlans)
+
+
+def _strip_vlans_from_ld_grps(adapter, nb, vlans):
+    """Removes VLANs from the load groups of a vnet aware Network Bridge.
+
+    :param adapter: The pypowervm adapter.
+    :param nb: The NetBridge wrapper.  Updated in place.
+    :param vlans: The VLANs to remove.  All are on the additional load
+                  groups.
+    """
+    for ld_grp in list(nb.load_grps[1:]):
+        ld_grp_vlans = set(ld_grp.tagged_vlans)
+        if not ld_grp_vlans & vlans:
+            continue
+
+        # A load balanced bridge needs at least two load groups.  Otherwise a
+        # load group without VLANs is removed.
+        if (ld_grp_vlans <= vlans and
+                (len(nb.load_grps) > 2 or not nb.load_balance)):
+            nb.load_grps.remove(ld_grp)
+            continue
+
+        # Only the virtual networks of the VLANs are removed.
+        for vnet_uri in list(ld_grp.vnet_uri_list):
+            vnet = pvm_net.VNet.wrap(adapter.read_by_href(vnet_uri))
+            if vnet.vlan in vlans:
+                ld_grp.vnet_uri_list.remove(vnet_uri)
+
+
+def _strip_vlans_from_trunks(nb, vlans):
+    """Removes VLANs from the trunk adapters of a Network Bridge.
+
+    :param nb: The NetBridge wrapper.  Updated in place.
+    :param vlans: The VLANs to remove.  All are on the additional trunk
+                  adapters.
+    """
+    sea = nb.seas[0]
+    for trunk in list(sea.addl_adpts):
+        trunk_vlans = set(trunk.tagged_vlans) & vlans
+        if not trunk_vlans:
+            continue
+
+        # The trunk adapter on the failover SEA mirrors this one.
+        trunks = [trunk]
+        for peer_sea in nb.seas[1:]:
+            trunks.extend(x for x in [peer_sea.primary_adpt] +
+                          list(peer_sea.addl_adpts) if x.pvid == trunk.pvid)
+
+        # A load balanced SEA needs at least one additional trunk adapter.
+        # Otherwise a trunk adapter without VLANs is removed.
+        remove = (trunk_vlans == set(trunk.tagged_vlans) and
+                  (len(sea.addl_adpts) > 1 or not nb.load_balance))
+        for ta in trunks:
+            if not remove:
+                ta.tagged_vlans = [x for x in ta.tagged_vlans
+                                   if x not in trunk_vlans]
+                continue
+            for each_sea in nb.seas:
+                if ta in each_sea.addl_adpts:
+                    each_sea.addl_adpts.remove(ta)
+                    break
+
+
+@pvm_retry.retry()
+def list_vioses(adapter, host_uuid):
+    """Queries for the Virtual I/O Servers on the system.
+
+    The network extended attribute group is included, so that the wrappers
+    can be used to reason about the Shared Ethernet Adapters.
+
+    :param adapter: The pypowervm adapter.
+    :param host_uuid: The UUID for the host system.
+    """
+    return _read_feed(adapter, pvm_vios.VIOS.wrap, pvm_ms.System.schema_type,
+                      root_id=host_uuid, child_type=pvm_vios.VIOS.schema_type,
+                      xag=[pvm_vios.VIOS.xags.NETWORK])
+
+
+class TopologyCache(object):
+    """Caches the network topology of the host.
+
+    The NetworkBridges and VirtualSwitches rarely change, but are needed on
+    every heal.  This cache holds on to their
+    wrappers until the API's event stream (or the agent itself, after it
+    writes to a bridge) indicates that they have changed.
+
+    The hits and misses are counted so that the effectiveness of the cache
+    can be observed.
+    """
+
+    # The types of the event URIs that invalidate each of the cached
+    # elements.  The VirtualNetworks back the NetworkBridges.  The VIOS
+    # events are left out.  Most of them are not network changes (ex. the
+    # storage mappings of each deploy), and the changes to the bridges come
+    # in as NetworkBridge events.
+    _BRIDGE_TYPES = (pvm_net.NetBridge.schema_type, pvm_net.VNet.schema_type)
+    _VSWITCH_TYPES = (pvm_net.VSwitch.schema_type,)
+
+    def __init__(self, adapter, host_uuid):
+        """Creates the cache.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The UUID for the host system.
+        """
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        self._bridges = None
+        self._vswitch_map = None
+        self._nb_vlan_map = None
+        self.hits = 0
+        self.misses = 0
+
+    def _count(self, cached):
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    def list_bridges(self):
+        """Returns the NetworkBridge wrappers.  See list_bridges."""
+        self._count(self._bridges)
+        if self._bridges is None:
+            self._bridges = list_bridges(self.adapter, self.host_uuid)
+        return self._bridges
+
+    def get_vswitch_map(self):
+        """Returns the vSwitch ID to URI map.  See get_vswitch_map."""
+        self._count(self._vswitch_map)
+        if self._vswitch_map is None:
+            self._vswitch_map = get_vswitch_map(self.adapter, self.host_uuid)
+        return self._vswitch_map
+
+    def get_nb_vlan_map(self):
+        """Returns the (vSwitch URI, VLAN) to NetworkBridge lookup table.
+
+        The table is only rebuilt when the NetworkBridges or VirtualSwitches
+        are invalidated.  See build_nb_vlan_map.
+        """
+        if self._nb_vlan_map is None:
+            self._nb_vlan_map = build_nb_vlan_map(self.list_bridges(),
+                                                  self.get_vswitch_map())
+        return self._nb_vlan_map
+
+    def invalidate_bridges(self):
+        """Invalidates the NetworkBridges, such as after an update to one."""
+        self._bridges = None
+        self._nb_vlan_map = None
+
+    def invalidate(self):
+        """Invalidates all of the cached topology."""
+        self.invalidate_bridges()
+        self._vswitch_map = None
+
+    def invalidate_for_uri(self, uri):
+        """Invalidates the cached topology impacted by an event URI.
+
+        :param uri: The URI of the event from the API.  The special 'general'
+                    URI (which indicates that the event system was reset)
+                    invalidates everything.
+        :return: True if the network bridges (or the virtual switches) may
+                 have changed.
+        """
+        if uri == 'general':
+            self.invalidate()
+            return True
+
+        changed = False
+        if self._uri_has_type(uri, self._BRIDGE_TYPES):
+            self.invalidate_bridges()
+            changed = True
+        if self._uri_has_type(uri, self._VSWITCH_TYPES):
+            self._vswitch_map = None
+            self._nb_vlan_map = None
+            changed = True
+        return changed
+
+    @staticmethod
+    def _uri_has_type(uri, schema_types):
+        path = pvm_util.dice_href(uri, include_query=False,
+                                  include_fragment=False)
+        segments = path.split('/')
+        return any(x in segments for x in schema_types)
+
+    @property
+    def stats(self):
+        """Returns the hit/miss counts of the cache."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
 def update_cna_pvid(cna, pvid):
     """This method will update the CNA with a new PVID.
 
@@ -335,19 +652,24 @@ def update_cna_pvid(cna, pvid):
 
     :param cna: The CNA wrapper (client network adapter).
     :param pvid: The new pvid to put on the wrapper.
+    :return: The updated CNA wrapper, with the new etag.
     """
 
     def _cna_argmod(this_try, max_tries, *args, **kwargs):
         # Refresh the CNA to get a new etag
         LOG.debug("Attempting to re-query a CNA to get latest etag.")
-        cna = args[0]
-        cna.refresh()
-        return args, kwargs
+        return (args[0].refresh(),) + args[1:], kwargs
 
     @pvm_retry.retry(argmod_func=_cna_argmod)
     def _func(cna, pvid):
         cna.pvid = pvid
-        cna.update()
+        return cna.update()
 
     # Run the function (w/ retry) to update the PVID
-    _func(cna, pvid)
+    try:
+        return _func(cna, pvid)
+    except Exception:
+        # The wrapper may be shared from a conditional read, and now holds
+        # a PVID that the API doesn't.  Make sure it is read again.
+        invalidate_feed_cache(child_type=pvm_net.CNA.schema_type)
+        raise
@@ -14,9 +14,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
+from oslo_concurrency import lockutils
+from oslo_config import cfg
 from oslo_log import log
 
 from neutron.common import topics
+from neutron import context as n_context
 from neutron.extensions import portbindings
 from neutron.plugins.common import constants as p_constants
 from neutron.plugins.ml2 import driver_api as api
@@ -24,10 +28,60 @@ from neutron.plugins.ml2.drivers import mech_agent
 from neutron.plugins.ml2 import rpc
 
 from networking_powervm.plugins.ibm.agent.powervm import constants as pconst
+from networking_powervm.plugins.ibm.agent.powervm.i18n import _
+from networking_powervm.plugins.ibm.agent.powervm.i18n import _LE
 
 LOG = log.getLogger(__name__)
 
 
+ml2_pvm_opts = [
+    cfg.FloatOpt('port_update_batch_window', default=0.1,
+                 help=_("The number of seconds the mechanism driver collects "
+                        "the ports bound to a PowerVM agent before notifying "
+                        "the agent of them in a single message.  Set to 0 to "
+                        "notify the agent of each port as it is bound."))
+]
+
+cfg.CONF.register_opts(ml2_pvm_opts, "ml2_powervm")
+
+
+class PvmSEANotifierApi(rpc.AgentNotifierApi):
+    """Agent notifier that can target the port update at a single host.
+
+    The PowerVM agents listen for port updates on a topic specific to their
+    host (as well as the standard fanout topic), and advertise it in their
+    configurations.  Casting the update to the binding host avoids waking
+    every agent in the region for each bind.
+    """
+
+    def port_update(self, context, port, network_type, segmentation_id,
+                    physical_network, host=None):
+        if host is None:
+            # No host to target, so fan out to all of the agents.
+            return super(PvmSEANotifierApi, self).port_update(
+                context, port, network_type, segmentation_id,
+                physical_network)
+
+        cctxt = self.client.prepare(
+            topic='%s.%s' % (self.topic_port_update, host), fanout=False)
+        cctxt.cast(context, 'port_update', port=port,
+                   network_type=network_type, segmentation_id=segmentation_id,
+                   physical_network=physical_network)
+
+    def ports_update(self, context, ports, host):
+        """Notifies the agent on the host of a batch of port updates.
+
+        :param context: The context for the cast.
+        :param ports: A list of dictionaries, each with the arguments of a
+                      port_update.
+        :param host: The host of the agent to notify.
+        """
+        cctxt = self.client.prepare(
+            topic='%s.%s' % (self.topic_port_update, host), fanout=False,
+            version=pconst.RPC_VERSION_PORTS_UPDATE)
+        cctxt.cast(context, 'ports_update', ports=ports)
+
+
 class PvmSEAMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
     """Attach to networks using PowerVM Shared Ethernet agent.
 
@@ -41,7 +95,10 @@ class PvmSEAMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
             pconst.AGENT_TYPE_PVM_SEA,
             pconst.VIF_TYPE_PVM_SEA,
             {portbindings.CAP_PORT_FILTER: False})
-        self.rpc_publisher = rpc.AgentNotifierApi(topics.AGENT)
+        self.rpc_publisher = PvmSEANotifierApi(topics.AGENT)
+
+        # The port updates waiting to be sent, per agent host.
+        self._pending_updates = {}
 
     def check_segment_for_agent(self, segment, agent):
         # TODO(thorst) Define appropriate mapping.  Determine whether
@@ -54,17 +111,90 @@ class PvmSEAMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
         # When this method is called, the parent should ideally be calling
         # down to the agent to state that the port was updated.  However,
         # it appears this isn't flowing properly.  This makes sure the
-        # port is passed down to the agent.
+        # port is passed down to the agent.  Only the agent on the binding
+        # host is notified if it can be, possibly along with other ports
+        # bound to it.
         bindable = (super(PvmSEAMechanismDriver, self).
                     try_to_bind_segment_for_agent(context, segment, agent))
         if bindable:
-            self.rpc_publisher.port_update(context._plugin_context,
-                                           context._port,
-                                           segment[api.NETWORK_TYPE],
-                                           segment[api.SEGMENTATION_ID],
-                                           segment[api.PHYSICAL_NETWORK])
+            self._notify_port_update(context, segment, agent)
         return bindable
 
+    def _notify_port_update(self, context, segment, agent):
+        """Sends the port update for a bound port to the agent.
+
+        If the agent supports the bulk ports_update RPC, the update is held
+        for the batch window so that it can be sent along with any other
+        ports bound to the same agent in that time.  Older agents are sent
+        a port_update per port.  Agents that do not listen on the topic of
+        their host are sent it on the fanout topic.
+        """
+        configs = agent.get('configurations', {})
+        host = None
+        if configs.get(pconst.AGENT_CAP_HOST_TOPIC, False):
+            host = agent.get('host')
+        update = {'port': context._port,
+                  'network_type': segment[api.NETWORK_TYPE],
+                  'segmentation_id': segment[api.SEGMENTATION_ID],
+                  'physical_network': segment[api.PHYSICAL_NETWORK]}
+        window = cfg.CONF.ml2_powervm.port_update_batch_window
+        bulk = configs.get(pconst.AGENT_CAP_PORTS_UPDATE, False)
+
+        if host is None or window <= 0 or not bulk:
+            self.rpc_publisher.port_update(context._plugin_context, host=host,
+                                           **update)
+            return
+
+        if self._queue_port_update(host, update):
+            eventlet.spawn_after(window, self._flush_port_updates, host)
+
+    @lockutils.synchronized('pvm_sea_port_updates')
+    def _queue_port_update(self, host, update):
+        """Adds the update to the host's batch.
+
+        :return: True if this started a new batch, which should be flushed
+                 at the end of the batch window.
+        """
+        new_batch = host not in self._pending_updates
+        self._pending_updates.setdefault(host, []).append(update)
+        return new_batch
+
+    @lockutils.synchronized('pvm_sea_port_updates')
+    def _pop_port_updates(self, host):
+        return self._pending_updates.pop(host, [])
+
+    def _flush_port_updates(self, host):
+        """Sends the batch of port updates for the host to its agent.
+
+        Runs in its own greenthread.  If the bulk update can not be sent, each
+        port update is sent on its own.
+        """
+        updates = self._pop_port_updates(host)
+        if not updates:
+            return
+
+        # The batch spans requests, so it is sent with an admin context.
+        context = n_context.get_admin_context()
+        if len(updates) > 1:
+            LOG.debug("Sending %(count)d port updates to the agent on "
+                      "%(host)s.", {'count': len(updates), 'host': host})
+            try:
+                self.rpc_publisher.ports_update(context, updates, host)
+                return
+            except Exception:
+                LOG.exception(_LE("Unable to send the port updates to the "
+                                  "agent on %s.  Sending them one by one."),
+                              host)
+
+        for update in updates:
+            try:
+                self.rpc_publisher.port_update(context, host=host, **update)
+            except Exception:
+                LOG.exception(_LE("Unable to send the update of port "
+                                  "%(port)s to the agent on %(host)s."),
+                              {'port': update['port'].get('id'),
+                               'host': host})
+
     def get_allowed_network_types(self, agent=None):
         return [p_constants.TYPE_VLAN]
 
@@ -14,9 +14,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import time
+
+import eventlet
+from eventlet import event
 import mock
 
 from oslo_config import cfg
+import oslo_messaging
 from pypowervm.tests import test_fixtures as pvm_fx
 
 from networking_powervm.plugins.ibm.agent.powervm import agent_base
@@ -89,6 +94,269 @@ class TestAgentBase(base.BasePVMTestCase):
         mock_provision.assert_called_with(provision_reqs)
         self.assertEqual(3, mock_dev_down.call_count)
 
+    def test_get_devices_details_list_unknown(self):
+        """Neutron is only asked once about the MACs it doesn't know."""
+        agent = self.build_test_agent()
+        rpc = agent.plugin_rpc.get_devices_details_list
+        rpc.return_value = [{'device': 'aa', 'mac_address': 'aa'},
+                            {'device': 'bb'}]
+
+        self.assertEqual(rpc.return_value,
+                         agent.get_devices_details_list(['aa', 'bb']))
+
+        # The unknown MAC is answered from the cache, in order.
+        rpc.return_value = [{'device': 'cc'}]
+        resp = agent.get_devices_details_list(['cc', 'bb', 'aa'])
+        rpc.assert_called_with(agent.context, ['cc'], 'pvm')
+        self.assertEqual([{'device': 'cc'}, {'device': 'bb'},
+                          {'device': 'aa', 'mac_address': 'aa'}], resp)
+
+        # Entirely from the cache, no RPC.
+        rpc.reset_mock()
+        self.assertEqual({'device': 'bb'}, agent.get_device_details('bb'))
+        self.assertFalse(rpc.called)
+        self.assertEqual({'size': 2, 'hits': 2, 'misses': 4,
+                          'hit_ratio': 2.0 / 6}, agent.unknown_macs.stats)
+
+        # A port update for the MAC means it is asked about again.
+        agent._update_port({'id': '1', 'mac_address': 'bb'})
+        rpc.return_value = [{'device': 'bb', 'mac_address': 'bb'}]
+        self.assertEqual({'device': 'bb', 'mac_address': 'bb'},
+                         agent.get_device_details('bb'))
+        rpc.assert_called_once_with(agent.context, ['bb'], 'pvm')
+
+    def test_get_devices_details_list_cache(self):
+        """Device details are cached until the port or network changes."""
+        agent = self.build_test_agent()
+        rpc = agent.plugin_rpc.get_devices_details_list
+        rpc.return_value = [
+            {'device': 'aa', 'mac_address': 'aa', 'network_id': 'n1'},
+            {'device': 'bb', 'mac_address': 'bb', 'network_id': 'n2'}]
+        devs = agent.get_devices_details_list(['aa', 'bb'])
+        self.assertEqual(devs, agent.get_devices_details_list(['aa', 'bb']))
+        self.assertEqual(1, rpc.call_count)
+
+        # A port update drops the port's details.
+        agent._update_port({'id': '1', 'mac_address': 'aa'})
+        rpc.return_value = [devs[0]]
+        agent.get_devices_details_list(['aa', 'bb'])
+        rpc.assert_called_with(agent.context, ['aa'], 'pvm')
+
+        # A network delete drops the details of its ports.
+        agent_base.PVMRpcCallbacks(agent).network_delete(
+            mock.Mock(), network_id='n2')
+        rpc.return_value = [devs[1]]
+        agent.get_devices_details_list(['aa', 'bb'])
+        rpc.assert_called_with(agent.context, ['bb'], 'pvm')
+        self.assertEqual(3, rpc.call_count)
+
+    def test_get_device_details_single_flight(self):
+        """Concurrent callers for a MAC share one request to Neutron."""
+        agent = self.build_test_agent()
+        dev = {'device': 'aa', 'mac_address': 'aa'}
+
+        def rpc(context, macs, agent_id):
+            eventlet.sleep(0.1)
+            return [dev for x in macs]
+        agent.plugin_rpc.get_devices_details_list.side_effect = rpc
+
+        threads = [eventlet.spawn(agent.get_device_details, 'aa')
+                   for x in range(5)]
+        self.assertEqual([dev] * 5, [x.wait() for x in threads])
+        self.assertEqual(1, agent.plugin_rpc.get_devices_details_list.
+                         call_count)
+
+        # A port update while in flight starts a new request, and the stale
+        # response isn't cached.
+        agent._invalidate_device('aa')
+        first = eventlet.spawn(agent.get_device_details, 'aa')
+        eventlet.sleep(0)
+        agent._update_port({'id': '1', 'mac_address': 'aa'})
+        second = eventlet.spawn(agent.get_device_details, 'aa')
+        first.wait()
+        second.wait()
+        self.assertEqual(3, agent.plugin_rpc.get_devices_details_list.
+                         call_count)
+
+        # An error is raised to all of the callers.
+        agent._invalidate_device('aa')
+        agent.plugin_rpc.get_devices_details_list.side_effect = FakeExc()
+        self.assertRaises(FakeExc, agent.get_device_details, 'aa')
+        self.assertEqual({}, agent._inflight)
+
+    def test_get_devices_details_list_short_reply(self):
+        """The MACs that Neutron does not respond to still end their flight.
+        """
+        agent = self.build_test_agent()
+        dev = {'device': 'aa', 'mac_address': 'aa'}
+
+        def rpc(context, macs, agent_id):
+            eventlet.sleep(0.1)
+            return [dev]
+        agent.plugin_rpc.get_devices_details_list.side_effect = rpc
+
+        first = eventlet.spawn(agent.get_devices_details_list, ['aa', 'bb'])
+        eventlet.sleep(0)
+        waiter = eventlet.spawn(agent.get_device_details, 'bb')
+        self.assertEqual([dev, {'device': 'bb'}], first.wait())
+        self.assertEqual({'device': 'bb'}, waiter.wait())
+        self.assertEqual({}, agent._inflight)
+        self.assertEqual(1, agent.plugin_rpc.get_devices_details_list.
+                         call_count)
+
+    def test_device_status(self):
+        """Device status changes are sent to Neutron in bulk."""
+        agent = self.build_test_agent()
+        rpc = agent.plugin_rpc
+        rpc.update_device_list.return_value = {
+            'devices_up': ['a'], 'failed_devices_up': [],
+            'devices_down': ['b', 'c'], 'failed_devices_down': []}
+
+        agent.update_device_up({'device': 'a'})
+        agent.update_device_up({'device': 'b'})
+        agent.update_device_down({'device': 'b'})
+        agent.update_device_down({'device': 'c'})
+        self.assertFalse(rpc.update_device_list.called)
+
+        # The latest status of each device is sent in one call.
+        agent.flush_device_status()
+        rpc.update_device_list.assert_called_once_with(
+            agent.context, ['a'], ['b', 'c'], 'pvm', cfg.CONF.host)
+        self.assertFalse(rpc.update_device_up.called)
+        self.assertFalse(rpc.update_device_down.called)
+
+        # Nothing to send.
+        agent.flush_device_status()
+        self.assertEqual(1, rpc.update_device_list.call_count)
+
+        # Reaching the batch size sends them right away.
+        cfg.CONF.set_override('device_status_batch_size', 2, 'AGENT')
+        agent.update_device_up({'device': 'd'})
+        agent.update_device_up({'device': 'e'})
+        self.assertEqual(2, rpc.update_device_list.call_count)
+
+    def test_device_status_fallback(self):
+        """Without the bulk call, each device status is sent."""
+        agent = self.build_test_agent()
+        rpc = agent.plugin_rpc
+        rpc.update_device_list.side_effect = (
+            oslo_messaging.UnsupportedVersion('1.5'))
+
+        agent.update_device_up({'device': 'a'})
+        agent.update_device_down({'device': 'b'})
+        agent.flush_device_status()
+        rpc.update_device_up.assert_called_once_with(
+            agent.context, 'a', 'pvm', cfg.CONF.host)
+        rpc.update_device_down.assert_called_once_with(
+            agent.context, 'b', 'pvm', cfg.CONF.host)
+
+        # The bulk call isn't tried again.
+        agent.update_device_up({'device': 'c'})
+        agent.flush_device_status()
+        self.assertEqual(1, rpc.update_device_list.call_count)
+        self.assertEqual(2, rpc.update_device_up.call_count)
+
+        # A failure is retried on the next flush.
+        rpc.update_device_up.side_effect = [FakeExc(), None]
+        agent.update_device_up({'device': 'd'})
+        agent.flush_device_status()
+        agent.flush_device_status()
+        rpc.update_device_up.assert_called_with(
+            agent.context, 'd', 'pvm', cfg.CONF.host)
+        self.assertEqual(4, rpc.update_device_up.call_count)
+
+    def test_wait_for_work(self):
+        """The wait ends as soon as the agent is woken."""
+        agent = self.build_test_agent()
+        cfg.CONF.set_override('polling_interval', 30, 'AGENT')
+        cfg.CONF.set_override('provision_batch_window', 0, 'AGENT')
+
+        eventlet.spawn_after(0.01, agent.wake)
+        start = time.time()
+        agent._wait_for_work()
+        self.assertLess(time.time() - start, 5)
+
+        # The wake up was consumed.
+        self.assertFalse(agent._wakeup.is_set())
+
+    def test_rpc_loop_port_update_latency(self):
+        """Measures the latency from a port_update to its provisioning."""
+        agent = self.build_test_agent()
+        cfg.CONF.set_override('polling_interval', 30, 'AGENT')
+        cfg.CONF.set_override('provision_batch_window', 0.05, 'AGENT')
+
+        provisioned = event.Event()
+        agent.heal_and_optimize = mock.Mock()
+        agent.build_prov_requests_from_server = mock.Mock(return_value=[])
+        agent.build_prov_requests_from_neutron = lambda: [
+            mock.Mock() for x in agent._list_updated_ports()]
+        agent.attempt_provision = lambda reqs: provisioned.send(time.time())
+
+        loop = eventlet.spawn(agent.rpc_loop)
+        try:
+            # Let the loop go idle, then send in the port update.
+            eventlet.sleep(0.1)
+            start = time.time()
+            agent_base.PVMRpcCallbacks(agent).port_update(
+                mock.Mock(), port={'id': '1', 'mac_address': 'aa'})
+            latency = provisioned.wait() - start
+        finally:
+            loop.kill()
+
+        # Rather than the polling interval, the latency is on the order of
+        # the batching window.
+        self.assertLess(latency, 1)
+
+    def test_rpc_loop_heal_in_background(self):
+        """A long heal doesn't hold up the provisioning of ports."""
+        agent = self.build_test_agent()
+        cfg.CONF.set_override('polling_interval', 30, 'AGENT')
+        cfg.CONF.set_override('provision_batch_window', 0, 'AGENT')
+
+        heal_done = event.Event()
+
+        def heal(is_boot):
+            eventlet.sleep(0.5)
+            heal_done.send(is_boot)
+        agent.heal_and_optimize = heal
+        agent.build_prov_requests_from_server = mock.Mock(return_value=[])
+        agent.build_prov_requests_from_neutron = lambda: [
+            mock.Mock(mac_address=x['mac_address'])
+            for x in agent._list_updated_ports()]
+        agent.provision_devices = mock.Mock()
+
+        loop = eventlet.spawn(agent.rpc_loop)
+        try:
+            # The port is provisioned while the heal is still running.
+            eventlet.sleep(0.1)
+            agent_base.PVMRpcCallbacks(agent).port_update(
+                mock.Mock(), port={'id': '1', 'mac_address': 'aa'})
+            eventlet.sleep(0.1)
+            self.assertEqual(1, agent.provision_devices.call_count)
+            self.assertFalse(heal_done.ready())
+
+            # The first heal is the boot heal.
+            self.assertTrue(heal_done.wait())
+            eventlet.sleep(0)
+        finally:
+            loop.kill()
+
+        self.assertIsNone(agent._heal_thread)
+        self.assertEqual(1, agent.heal_stats['runs'])
+        self.assertGreaterEqual(agent.heal_stats['last_duration'], 0.5)
+
+    def test_record_provision_latency(self):
+        """Only the provisioning during a heal is recorded."""
+        agent = self.build_test_agent()
+        agent.record_provision_latency(time.time())
+        self.assertEqual(0, agent.heal_stats['provisions_during_heal'])
+
+        agent._heal_thread = mock.Mock()
+        agent.record_provision_latency(time.time() - 1)
+        self.assertEqual(1, agent.heal_stats['provisions_during_heal'])
+        self.assertGreaterEqual(
+            agent.heal_stats['max_provision_latency_during_heal'], 1)
+
     @mock.patch('pypowervm.utils.uuid.convert_uuid_to_pvm')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.agent_base.'
                 'BasePVMNeutronAgent._list_updated_ports')
@@ -103,19 +371,132 @@ class TestAgentBase(base.BasePVMTestCase):
 
         def build_port(pid, use_good_host=True):
             if use_good_host:
-                return {'id': pid, 'binding:host_id': 'fake_host'}
+                return {'id': pid, 'binding:host_id': 'fake_host',
+                        'mac_address': 'm' + pid}
             else:
-                return {'id': pid, 'binding:host_id': 'bad_fake_host'}
+                return {'id': pid, 'binding:host_id': 'bad_fake_host',
+                        'mac_address': 'm' + pid}
 
         # Only 2 should be created
         mock_list_uports.return_value = [build_port('1'), {}, build_port('2'),
+                                         build_port('3'),
                                          build_port('4', use_good_host=False)]
-        devs = [{'port_id': '3'}, {}, {'port_id': '1'}, {'port_id': '2'}]
+        devs = [{'port_id': '1'}, {'port_id': '2'}, {'port_id': '5'}]
         agent.plugin_rpc.get_devices_details_list.return_value = devs
 
         resp = agent.build_prov_requests_from_neutron()
         self.assertEqual(2, len(resp))
 
+        # Only the ports for this host were sent to the server.
+        agent.plugin_rpc.get_devices_details_list.assert_called_once_with(
+            agent.context, ['m1', 'm2', 'm3'], agent.agent_id)
+
+        # No RPC if none of the ports are for this host.
+        agent.plugin_rpc.get_devices_details_list.reset_mock()
+        mock_list_uports.return_value = [{}, build_port('4', False)]
+        self.assertEqual([], agent.build_prov_requests_from_neutron())
+        self.assertFalse(agent.plugin_rpc.get_devices_details_list.called)
+
+
+class TestPVMRpcCallbacks(base.BasePVMTestCase):
+
+    def test_ports_update(self):
+        agent = mock.Mock()
+        callbacks = agent_base.PVMRpcCallbacks(agent)
+        callbacks.ports_update(mock.Mock(), ports=[
+            {'port': {'id': '1'}, 'network_type': 'vlan'},
+            {'port': {'id': '2'}, 'network_type': 'vlan'}])
+        agent._update_port.assert_has_calls(
+            [mock.call({'id': '1'}), mock.call({'id': '2'})])
+
+
+class TestTTLCache(base.BasePVMTestCase):
+
+    @mock.patch('time.time')
+    def test_ttl(self, mock_time):
+        mock_time.return_value = 100
+        cache = agent_base.TTLCache(10, 5)
+        cache.put('a', 1)
+        self.assertEqual(1, cache.get('a'))
+
+        # Expires after the TTL.
+        mock_time.return_value = 111
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, len(cache))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+        # A TTL of 0 disables the cache.
+        cache = agent_base.TTLCache(0, 5)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_size(self):
+        cache = agent_base.TTLCache(10, 2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('c', 3)
+
+        # The oldest is evicted.
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+        cache.pop('c')
+        cache.pop('not_there')
+        self.assertEqual('x', cache.get('c', 'x'))
+
+    def test_evict(self):
+        cache = agent_base.TTLCache(10, 5)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.evict(lambda x: x > 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+
+class TestPortUpdateQueue(base.BasePVMTestCase):
+
+    def test_coalesce(self):
+        """A storm of updates for a few ports is reduced to those ports."""
+        queue = agent_base.PortUpdateQueue(10)
+        for x in range(100):
+            queue.put({'id': str(x % 5), 'seq': x}, 1)
+
+        ports = queue.swap()
+        self.assertEqual(5, len(ports))
+
+        # The latest update for each port wins.
+        self.assertEqual({95, 96, 97, 98, 99}, {x['seq'] for x in ports})
+        self.assertEqual(0, len(queue))
+        self.assertEqual({'size': 0, 'received': 100, 'coalesced': 95,
+                          'overflows': 0, 'high_water': 5}, queue.stats)
+
+    def test_full(self):
+        """A full queue waits to be drained, then overflows."""
+        on_full = mock.Mock()
+        queue = agent_base.PortUpdateQueue(2, on_full=on_full)
+        queue.put({'id': '1'}, 0)
+        queue.put({'id': '2'}, 0)
+
+        # An update to a queued port doesn't need room.
+        queue.put({'id': '2'}, 0)
+        self.assertFalse(on_full.called)
+
+        # No one drains the queue, so the new port overflows it.
+        queue.put({'id': '3'}, 0.01)
+        on_full.assert_called_once_with()
+        self.assertEqual(1, queue.stats['overflows'])
+        self.assertEqual(3, len(queue.swap()))
+
+        # If drained while waiting, there is no overflow.
+        queue.put({'id': '1'}, 0)
+        queue.put({'id': '2'}, 0)
+        on_full.side_effect = lambda: eventlet.spawn_after(0.01, queue.swap)
+        queue.put({'id': '3'}, 5)
+        self.assertEqual(1, queue.stats['overflows'])
+        self.assertEqual([{'id': '3'}], queue.swap())
+
 
 class TestProvisionRequest(base.BasePVMTestCase):
 
@@ -14,6 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import time
+
+import eventlet
 from oslo_config import cfg
 
 import mock
@@ -27,8 +30,9 @@ from neutron.common import constants as q_const
 from neutron import context as ctx
 
 
-def FakeClientAdpt(mac, pvid, tagged_vlans):
-    return mock.MagicMock(mac=mac, pvid=pvid, tagged_vlans=tagged_vlans)
+def FakeClientAdpt(mac, pvid, tagged_vlans, vswitch_uri='vsw_uri'):
+    return mock.MagicMock(mac=mac, pvid=pvid, tagged_vlans=tagged_vlans,
+                          vswitch_uri=vswitch_uri)
 
 
 def FakeNPort(mac, segment_id, phys_network):
@@ -37,9 +41,10 @@ def FakeNPort(mac, segment_id, phys_network):
                      physical_network=phys_network, lpar_uuid='lpar_uuid')
 
 
-def FakeNB(uuid, pvid, tagged_vlans, addl_vlans):
+def FakeNB(uuid, pvid, tagged_vlans, addl_vlans, vswitch_id='0'):
     m = mock.MagicMock()
     m.uuid = uuid
+    m.vswitch_id = vswitch_id
 
     lg = mock.MagicMock()
     lg.pvid = pvid
@@ -54,6 +59,12 @@ def FakeNB(uuid, pvid, tagged_vlans, addl_vlans):
     return m
 
 
+def _wait_for_writes(nb_writer):
+    """Waits until the network bridge writers have made all their writes."""
+    while nb_writer._writers:
+        eventlet.sleep(0.01)
+
+
 class FakeException(Exception):
     """Used to indicate an error in an API the agent calls."""
     pass
@@ -97,10 +108,15 @@ class SEAAgentTest(base.BasePVMTestCase):
         """
         self.assertEqual(0, len(self.agent._list_updated_ports()))
 
-        self.agent._update_port({'mac_address': 'aa'})
-        self.agent._update_port({'mac_address': 'bb'})
+        self.agent._update_port({'id': '1', 'mac_address': 'aa'})
+        self.agent._update_port({'id': '2', 'mac_address': 'bb'})
 
-        self.assertEqual(2, len(self.agent._list_updated_ports()))
+        # A second update to the same port replaces the first.
+        self.agent._update_port({'id': '1', 'mac_address': 'cc'})
+
+        ports = self.agent._list_updated_ports()
+        self.assertEqual(2, len(ports))
+        self.assertIn({'id': '1', 'mac_address': 'cc'}, ports)
 
         # This should now be reset back to zero length
         self.assertEqual(0, len(self.agent._list_updated_ports()))
@@ -121,76 +137,119 @@ class SEAAgentTest(base.BasePVMTestCase):
         configs = self.agent.agent_state.get('configurations')
         self.assertEqual(0, configs['devices'])
 
+        # The bulk port update and the host topic are advertised to the
+        # mechanism driver.
+        self.assertTrue(configs['ports_update'])
+        self.assertTrue(configs['port_update_host_topic'])
+
         # Make sure we flipped to None after the report.  Also
         # indicates that we hit the last part of the method and didn't
         # fail.
         self.assertIsNone(self.agent.agent_state.get('start_flag'))
 
-    @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
-    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils')
-    def test_provision_devices(self, mock_utils, mock_ensure):
+    def test_provision_devices(self):
         """Validates that the provision is invoked with batched VLANs."""
-        self.agent.api_utils = mock_utils
         self.agent.br_map = {'default': 'nb_uuid'}
         self.agent.pvid_updater = mock.MagicMock()
+        self.agent.nb_writer = mock.MagicMock()
 
         # Invoke
         self.agent.provision_devices([FakeNPort('aa', 20, 'default'),
                                       FakeNPort('bb', 22, 'default')])
 
-        # Validate that both VLANs are in one call
-        mock_ensure.assert_called_once_with(mock.ANY, mock.ANY, 'nb_uuid',
-                                            {20, 22})
+        # Validate that both VLANs are in one write, and are recorded as
+        # being provisioned.
+        self.agent.nb_writer.add_vlans.assert_called_once_with(
+            'nb_uuid', {20, 22}, callback=mock.ANY)
+        self.assertEqual({20: None, 22: None},
+                         self.agent._provisioned_vlans['nb_uuid'])
 
-        # Validate that the PVID updates were completed
+        # The PVID updates are only started once the VLANs are written.  The
+        # latency is recorded then, as a heal is running.
+        self.agent._heal_thread = mock.Mock()
+        self.assertEqual(0, self.agent.pvid_updater.add.call_count)
+        self.agent.nb_writer.add_vlans.call_args[1]['callback'](None)
         self.assertEqual(2, self.agent.pvid_updater.add.call_count)
+        self.assertEqual(1, self.agent.heal_stats['provisions_during_heal'])
 
-    @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
-    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils')
-    def test_provision_devices_fails(self, mock_utils, mock_ensure):
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.agent_base.'
+                'BasePVMNeutronAgent.update_device_down')
+    def test_provision_devices_fails(self, mock_dev_down):
         """Validates that behavior of a failed VLAN provision."""
-        self.agent.api_utils = mock_utils
         self.agent.br_map = {'default': 'nb_uuid'}
         self.agent.pvid_updater = mock.MagicMock()
+        self.agent.nb_writer = mock.MagicMock()
 
-        # Have the ensure throw some exception
-        mock_ensure.side_effect = FakeException()
-
-        # Invoke
-        self.assertRaises(FakeException, self.agent.provision_devices,
-                          [FakeNPort('aa', 20, 'default'),
-                           FakeNPort('bb', 22, 'default')])
-
-        # Validate that both VLANs are in one call.  Should still occur even
-        # though no exception.
-        mock_ensure.assert_called_once_with(mock.ANY, mock.ANY, 'nb_uuid',
-                                            {20, 22})
+        # Invoke, and have the write fail.
+        self.agent.provision_devices([FakeNPort('aa', 20, 'default'),
+                                      FakeNPort('bb', 22, 'default')])
+        self.agent.nb_writer.add_vlans.call_args[1]['callback'](
+            FakeException())
 
-        # However, the pvid updater should not be invoked.
+        # The devices are set down, and the pvid updater is not invoked.
+        self.assertEqual(2, mock_dev_down.call_count)
         self.assertEqual(0, self.agent.pvid_updater.add.call_count)
 
-    @mock.patch('pypowervm.tasks.network_bridger.remove_vlan_from_nb')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.agent_base.'
+                'BasePVMNeutronAgent.update_device_down')
+    @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
+    def test_provision_devices_multi_nb(self, mock_ensure, mock_dev_down):
+        """The bridges are provisioned concurrently, and fail separately."""
+        cfg.CONF.set_override('nb_write_window_ms', 0, 'AGENT')
+        self.agent.br_map = {'phys1': 'nb1', 'phys2': 'nb2', 'phys3': 'nb3'}
+        self.agent.pvid_updater = mock.MagicMock()
+        self.agent.topology = mock.MagicMock()
+
+        in_flight = set()
+        max_in_flight = [0]
+
+        def ensure(adapter, host_uuid, nb_uuid, vlans):
+            in_flight.add(nb_uuid)
+            max_in_flight[0] = max(max_in_flight[0], len(in_flight))
+            eventlet.sleep(0.05)
+            in_flight.discard(nb_uuid)
+            if nb_uuid == 'nb2':
+                raise FakeException()
+        mock_ensure.side_effect = ensure
+
+        p_req2 = FakeNPort('bb', 21, 'phys2')
+        self.agent.provision_devices([FakeNPort('aa', 20, 'phys1'), p_req2,
+                                      FakeNPort('cc', 22, 'phys3')])
+        _wait_for_writes(self.agent.nb_writer)
+
+        # Only the failed bridge's request is set down.  The others go on to
+        # have their PVIDs updated.
+        mock_dev_down.assert_called_once_with(p_req2.rpc_device)
+        self.assertEqual(2, self.agent.pvid_updater.add.call_count)
+        self.assertEqual(3, max_in_flight[0])
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'remove_vlans_from_nb')
     @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
                 'get_vswitch_map')
-    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.list_cnas')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'list_bridges')
+                'list_cnas_by_lpar')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'find_nb_for_cna')
+                'list_bridges')
     def test_heal_and_optimize(
-            self, mock_find_nb_for_cna, mock_list_bridges, mock_list_cnas,
-            mock_vs_map, mock_nbr_ensure, mock_nbr_remove):
+            self, mock_list_bridges, mock_list_cnas, mock_vs_map,
+            mock_nbr_ensure, mock_nbr_remove):
         """Validates the heal and optimization code."""
-        # Fake adapters already on system.
+        # Fake adapters already on system.  The second adapter is on VLAN 44
+        # of the second network bridge, so that VLAN must be kept.
         adpts = [FakeClientAdpt('00', 30, []),
-                 FakeClientAdpt('11', 31, [32, 33, 34])]
-        mock_list_cnas.return_value = adpts
+                 FakeClientAdpt('11', 44, [32, 33, 34])]
+        mock_vs_map.return_value = {'0': 'vsw_uri'}
+        mock_list_cnas.return_value = {'lpar1': adpts}
 
         # The neutron data.  These will be 'ensured' on the bridge.
         self.agent.plugin_rpc = mock.MagicMock()
         self.agent.plugin_rpc.get_devices_details_list.return_value = [
-            FakeNPort('00', 20, 'default'), FakeNPort('22', 22, 'default')]
+            {'device': '00', 'mac_address': '00',
+             'physical_network': 'default', 'segmentation_id': 20},
+            {'device': '11', 'mac_address': '11',
+             'physical_network': 'default', 'segmentation_id': 22}]
 
         self.agent.br_map = {'default': 'nb_uuid'}
 
@@ -204,32 +263,53 @@ class SEAAgentTest(base.BasePVMTestCase):
         mock_nb1 = FakeNB('nb_uuid', 20, [], [])
         mock_nb2 = FakeNB('nb2_uuid', 40, [41, 42, 43], [44, 45, 46, 47])
         mock_list_bridges.return_value = [mock_nb1, mock_nb2]
-        mock_find_nb_for_cna.return_value = mock_nb2
 
         # Invoke
         self.agent.heal_and_optimize(False)
 
-        # Verify.  One ensure call per net bridge.
-        self.assertEqual(3, mock_nbr_remove.call_count)
-        self.assertEqual(2, mock_nbr_ensure.call_count)
+        # Verify.  Only the VLAN missing from the first network bridge is
+        # ensured.  The second bridge isn't missing any, so is not written.
+        # VLAN 44 is in use by a client adapter, so only 45 and 46 are
+        # removed, in one batch.
+        mock_nbr_ensure.assert_called_once_with(mock.ANY, mock.ANY,
+                                                'nb_uuid', {22})
+        mock_nbr_remove.assert_called_once_with(mock.ANY, mock.ANY,
+                                                'nb2_uuid', [45, 46])
 
-    @mock.patch('pypowervm.tasks.network_bridger.remove_vlan_from_nb')
+        # Nothing has changed, so the next pass makes no calls at all.
+        self.agent.heal_and_optimize(False)
+        self.assertEqual(1, mock_list_cnas.call_count)
+        self.assertEqual(1, mock_vs_map.call_count)
+        self.assertEqual(1, mock_list_bridges.call_count)
+        self.assertEqual(1, mock_nbr_ensure.call_count)
+
+        # Once an LPAR changes, only that LPAR is read.  The vSwitches come
+        # from the topology cache.  The bridges were written, so they are read
+        # again.
+        self.agent.mark_lpar_dirty('lpar1')
+        self.agent.heal_and_optimize(False)
+        mock_list_cnas.assert_called_with(mock.ANY, mock.ANY,
+                                          lpar_uuids=['lpar1'])
+        self.assertEqual(1, mock_vs_map.call_count)
+        self.assertEqual(2, mock_list_bridges.call_count)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'remove_vlans_from_nb')
     @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
                 'get_vswitch_map')
-    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.list_cnas')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'list_bridges')
+                'list_cnas_by_lpar')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'find_nb_for_cna')
+                'list_bridges')
     def test_heal_and_optimize_no_remove(
-            self, mock_find_nb_for_cna, mock_list_bridges, mock_list_cnas,
-            mock_vs_map, mock_nbr_ensure, mock_nbr_remove):
+            self, mock_list_bridges, mock_list_cnas, mock_vs_map,
+            mock_nbr_ensure, mock_nbr_remove):
         """Validates the heal and optimization code. No remove."""
         # Fake adapters already on system.
         adpts = [FakeClientAdpt('00', 30, []),
                  FakeClientAdpt('11', 31, [32, 33, 34])]
-        mock_list_cnas.return_value = adpts
+        mock_list_cnas.return_value = {'lpar1': adpts}
 
         # The neutron data.  These will be 'ensured' on the bridge.
         self.agent.plugin_rpc = mock.MagicMock()
@@ -248,7 +328,7 @@ class SEAAgentTest(base.BasePVMTestCase):
         mock_nb1 = FakeNB('nb_uuid', 20, [], [])
         mock_nb2 = FakeNB('nb2_uuid', 40, [41, 42, 43], [44, 45, 46, 47])
         mock_list_bridges.return_value = [mock_nb1, mock_nb2]
-        mock_find_nb_for_cna.return_value = mock_nb2
+        mock_vs_map.return_value = {'0': 'vsw_uri'}
 
         # Set that we can't do the clean up
         cfg.CONF.set_override('automated_powervm_vlan_cleanup', False, 'AGENT')
@@ -256,10 +336,147 @@ class SEAAgentTest(base.BasePVMTestCase):
         # Invoke
         self.agent.heal_and_optimize(False)
 
-        # Verify.  One ensure call per net bridge.  Zero for the remove as that
-        # has been flagged to not clean up.
+        # Verify.  The bridges have all the VLANs they need, so aren't
+        # written.  Zero for the remove as that has been flagged to not clean
+        # up.
         self.assertEqual(0, mock_nbr_remove.call_count)
-        self.assertEqual(2, mock_nbr_ensure.call_count)
+        self.assertEqual(0, mock_nbr_ensure.call_count)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.sea_agent.'
+                'SharedEthernetNeutronAgent._heal_and_optimize')
+    def test_heal_and_optimize_scope(self, mock_heal):
+        """Validates which parts of the system each heal looks at."""
+        # The first heal is always a full heal.
+        self.agent.heal_and_optimize(False)
+        mock_heal.assert_called_once_with(False, True, set(), set(), False)
+        self.agent._full_heal_needed = False
+        self.agent._last_full_heal = time.time()
+
+        # Without changes, nothing is healed.
+        mock_heal.reset_mock()
+        self.agent.heal_and_optimize(False)
+        self.assertFalse(mock_heal.called)
+
+        # Only the changes are healed.
+        self.agent.mark_lpar_dirty('lpar1')
+        self.agent.mark_topology_dirty()
+        self.agent.heal_and_optimize(False)
+        mock_heal.assert_called_once_with(False, False, {'lpar1'}, set(),
+                                          True)
+
+        # A failed heal retries the changes on the next pass.
+        mock_heal.reset_mock()
+        mock_heal.side_effect = FakeException()
+        self.agent.mark_lpar_dirty('lpar2')
+        self.assertRaises(FakeException, self.agent.heal_and_optimize, False)
+        self.assertEqual({'lpar2'}, self.agent._dirty_lpars)
+
+        # A full sweep is made once the interval has passed.
+        mock_heal.reset_mock()
+        mock_heal.side_effect = None
+        self.agent._dirty_lpars = set()
+        self.agent._full_heal_needed = False
+        self.agent._last_full_heal = time.time() - 3601
+        self.agent.heal_and_optimize(False)
+        mock_heal.assert_called_once_with(False, True, set(), set(), False)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'remove_vlans_from_nb')
+    @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'get_vswitch_map')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_cnas_by_lpar')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_bridges')
+    def test_heal_and_optimize_incremental(
+            self, mock_list_bridges, mock_list_cnas, mock_vs_map,
+            mock_nbr_ensure, mock_nbr_remove):
+        """An incremental heal only ensures the VLANs that changed."""
+        cfg.CONF.set_override('automated_powervm_vlan_cleanup', False, 'AGENT')
+        self.agent.cna_index.update('lpar2', [FakeClientAdpt('BBBB', 21, [])])
+        mock_list_cnas.return_value = {
+            'lpar1': [FakeClientAdpt('AAAA', 20, [])]}
+        mock_vs_map.return_value = {'0': 'vsw_uri'}
+        mock_list_bridges.return_value = [FakeNB('nb_uuid', 1, [], [])]
+        self.agent.br_map = {'default': 'nb_uuid'}
+        self.agent.pvid_updater = mock.MagicMock(pending_vlans=set())
+        self.agent.plugin_rpc = mock.MagicMock()
+        self.agent.plugin_rpc.get_devices_details_list.return_value = [
+            {'device': 'aa:aa', 'mac_address': 'aa:aa',
+             'physical_network': 'default', 'segmentation_id': 20}]
+
+        self.agent._heal_and_optimize(False, False, {'lpar1'}, set(), False)
+
+        # Only the changed LPAR is read, and only its MAC is looked up.
+        mock_list_cnas.assert_called_once_with(mock.ANY, mock.ANY,
+                                               lpar_uuids=['lpar1'])
+        self.assertEqual(
+            ['aa:aa'],
+            self.agent.plugin_rpc.get_devices_details_list.call_args[0][1])
+        mock_nbr_ensure.assert_called_once_with(mock.ANY, mock.ANY,
+                                                'nb_uuid', {20})
+        self.assertEqual(2, len(self.agent.cna_index.all_cnas()))
+
+        # Once the bridge has the VLAN, it isn't written again.
+        mock_list_bridges.return_value = [FakeNB('nb_uuid', 1, [20], [])]
+        self.agent.topology.invalidate()
+        self.agent._heal_and_optimize(False, False, {'lpar1'}, set(), False)
+        self.assertEqual(1, mock_nbr_ensure.call_count)
+
+        # Without any changes to the LPARs, Neutron is not asked.
+        self.agent.plugin_rpc.reset_mock()
+        self.agent._heal_and_optimize(False, False, set(), set(), False)
+        self.assertFalse(
+            self.agent.plugin_rpc.get_devices_details_list.called)
+
+        # The unused VLANs are left for a full heal to remove.
+        cfg.CONF.set_override('automated_powervm_vlan_cleanup', True, 'AGENT')
+        mock_list_bridges.return_value = [FakeNB('nb_uuid', 1, [20], [30])]
+        self.agent.topology.invalidate()
+        self.agent._heal_and_optimize(False, False, {'lpar1'}, set(), False)
+        self.assertFalse(mock_nbr_remove.called)
+
+        # The provisioned VLANs written before the heal began are forgotten.
+        self.agent._provisioned_vlans['nb_uuid'].update(
+            {30: None, 31: 0, 32: time.time() + 60})
+        self.agent._heal_and_optimize(False, False, set(), set(), False)
+        self.assertEqual({30, 32},
+                         set(self.agent._provisioned_vlans['nb_uuid']))
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'remove_vlans_from_nb')
+    def test_remove_unused_vlans(self, mock_nbr_remove):
+        """VLANs provisioned or pending since the heal began are kept."""
+        self.agent.pvid_updater = mock.MagicMock()
+        self.agent.pvid_updater.pending_vlans = {44}
+        self.agent._provisioned_vlans['nb2_uuid'][45] = None
+        mock_nb = FakeNB('nb2_uuid', 40, [41], [44, 45, 46, 47])
+
+        self.agent._remove_unused_vlans(mock_nb, {40, 41}, {47}).wait()
+        mock_nbr_remove.assert_called_once_with(mock.ANY, mock.ANY,
+                                                'nb2_uuid', [46])
+
+        # Nothing to remove, so nothing is queued.
+        self.assertIsNone(self.agent._remove_unused_vlans(
+            mock_nb, {40, 41, 46}, {47}))
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'remove_vlans_from_nb')
+    def test_remove_unused_vlans_batches(self, mock_nbr_remove):
+        """Each heal removes a batch of the configured size."""
+        cfg.CONF.set_override('vlan_cleanup_batch_size', 2, 'AGENT')
+        self.agent.pvid_updater = mock.MagicMock(pending_vlans=set())
+        self.agent.topology = mock.MagicMock()
+        mock_nb = FakeNB('nb_uuid', 40, [], [41, 42, 43, 44, 45])
+
+        self.agent._remove_unused_vlans(mock_nb, {40}, set()).wait()
+        mock_nbr_remove.assert_called_once_with(mock.ANY, mock.ANY,
+                                                'nb_uuid', [41, 42])
+        self.agent.topology.invalidate_bridges.assert_called_once_with()
+
+        # The next heal is a full heal, which removes the rest.
+        self.assertTrue(self.agent._full_heal_needed)
 
     @mock.patch('oslo_service.loopingcall.FixedIntervalLoopingCall')
     @mock.patch.object(ctx, 'get_admin_context_without_session',
@@ -294,6 +511,8 @@ class PVIDLooperTest(base.BasePVMTestCase):
         super(PVIDLooperTest, self).setUp()
 
         self.mock_agent = mock.MagicMock()
+        self.mock_agent.cna_index = sea_agent.CNAIndex(mock.Mock(),
+                                                       'host_uuid')
         self.looper = sea_agent.PVIDLooper(self.mock_agent)
 
     def build_update_req(self, mac, lpar, vlan):
@@ -327,24 +546,44 @@ class PVIDLooperTest(base.BasePVMTestCase):
         self.looper.add(self.build_update_req('bb', '1', 2))
         self.assertEqual(3, len(self.looper.requests))
 
+    def test_pending_vlans(self):
+        """The pending VLANs are counted as the requests come and go."""
+        reqs = [self.build_update_req('aa', '1', 1),
+                self.build_update_req('bb', '1', 2),
+                self.build_update_req('aa', '2', 1)]
+        for req in reqs:
+            self.looper.add(req)
+        self.looper.add(self.build_update_req('aa', '1', 1))
+        self.assertEqual({1, 2}, self.looper.pending_vlans)
+
+        # VLAN 1 is pending until both of its requests are removed.
+        self.looper._remove_request(reqs[0])
+        self.assertEqual({1, 2}, self.looper.pending_vlans)
+        self.looper._remove_request(reqs[2])
+        self.assertEqual({2}, self.looper.pending_vlans)
+
+        # Removing a request twice doesn't throw off the count.
+        self.looper._remove_request(reqs[2])
+        self.looper._remove_request(reqs[1])
+        self.assertEqual(set(), self.looper.pending_vlans)
+        self.assertEqual(0, len(self.looper.requests))
+
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
                 'list_lpar_uuids')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'list_cnas')
+                'list_cnas_by_lpar')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
                 'update_cna_pvid')
-    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'find_cna_for_mac')
-    def test_update(self, mock_find_cna_for_mac, mock_update_cna_pvid,
-                    mock_list_cnas, mock_uuids):
-        req = sea_agent.UpdateVLANRequest(FakeNPort('a', 27, 'phys_net'))
+    def test_update(self, mock_update_cna_pvid, mock_list_cnas, mock_uuids):
+        req = self.build_update_req('aa:bb:cc:dd:ee:ff', 'lpar_uuid', 27)
         self.looper.add(req)
 
         # Mock the element returned
-        mock_cna = mock.MagicMock()
-        mock_find_cna_for_mac.return_value = mock_cna
-        mock_list_cnas.return_value = [mock_cna]
+        mock_cna = mock.MagicMock(mac='AABBCCDDEEFF', pvid=1)
+        mock_list_cnas.return_value = {'lpar_uuid': [mock_cna]}
         mock_uuids.return_value = ['lpar_uuid']
+        updated_cna = mock.MagicMock(mac='AABBCCDDEEFF', pvid=27)
+        mock_update_cna_pvid.return_value = updated_cna
 
         # Call the update
         self.looper.update()
@@ -355,6 +594,10 @@ class PVIDLooperTest(base.BasePVMTestCase):
         # Make sure the mock CNA had update called, and the vid set correctly
         mock_update_cna_pvid.assert_called_with(mock_cna, 27)
 
+        # The index keeps the updated wrapper.
+        self.assertEqual([updated_cna],
+                         self.mock_agent.cna_index.list_cnas('lpar_uuid'))
+
         # Make sure the port was updated
         self.assertFalse(self.mock_agent.update_device_down.called)
         self.assertTrue(self.mock_agent.update_device_up.called)
@@ -362,9 +605,91 @@ class PVIDLooperTest(base.BasePVMTestCase):
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
                 'list_lpar_uuids')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'list_cnas')
+                'list_cnas_by_lpar')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'update_cna_pvid')
+    def test_update_fails(self, mock_update_cna_pvid, mock_list_cnas,
+                          mock_uuids):
+        """A failed update drops the LPAR's adapters from the index."""
+        req = self.build_update_req('aa:bb:cc:dd:ee:ff', 'lpar_uuid', 27)
+        self.looper.add(req)
+        mock_cna = mock.MagicMock(mac='AABBCCDDEEFF', pvid=1)
+        self.mock_agent.cna_index.update('lpar_uuid', [mock_cna])
+        mock_uuids.return_value = ['lpar_uuid']
+        mock_update_cna_pvid.side_effect = FakeException()
+
+        self.looper.update()
+        self.assertEqual(1, len(self.looper.requests))
+        self.assertFalse(mock_list_cnas.called)
+
+        # The next try reads the adapters again.
+        mock_update_cna_pvid.side_effect = None
+        mock_update_cna_pvid.return_value = mock_cna
+        mock_list_cnas.return_value = {'lpar_uuid': [mock_cna]}
+        self.looper.update()
+        self.assertEqual(1, mock_list_cnas.call_count)
+        self.assertEqual(0, len(self.looper.requests))
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_lpar_uuids')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_cnas_by_lpar')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'update_cna_pvid')
+    def test_update_indexed(self, mock_update_cna_pvid, mock_list_cnas,
+                            mock_uuids):
+        """An indexed adapter is updated without reading its LPAR."""
+        req = self.build_update_req('aa:bb:cc:dd:ee:ff', 'lpar_uuid', 27)
+        self.looper.add(req)
+
+        mock_cna = mock.MagicMock(mac='AABBCCDDEEFF', pvid=27)
+        self.mock_agent.cna_index.update('lpar_uuid', [mock_cna])
+        mock_uuids.return_value = ['lpar_uuid']
+
+        self.looper.update()
+
+        # Already on the right PVID and found from the index.
+        self.assertEqual(0, len(self.looper.requests))
+        self.assertFalse(mock_list_cnas.called)
+        self.assertFalse(mock_update_cna_pvid.called)
+        self.assertTrue(self.mock_agent.update_device_up.called)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_lpar_uuids')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_cnas_by_lpar')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'update_cna_pvid')
+    def test_update_grouped(self, mock_update_cna_pvid, mock_list_cnas,
+                            mock_uuids):
+        """The CNAs of each LPAR are read once, for all its requests."""
+        lpar_cnas = {}
+        for lpar in ('lpar1', 'lpar2', 'lpar3'):
+            lpar_cnas[lpar] = []
+            for x in range(4):
+                mac = '%s:00:00:00:00:0%d' % (lpar[-1] * 2, x)
+                self.looper.add(self.build_update_req(mac, lpar, 27))
+                lpar_cnas[lpar].append(mock.MagicMock(
+                    mac=mac.replace(':', '').upper(), pvid=27))
+        mock_list_cnas.return_value = lpar_cnas
+        mock_uuids.return_value = ['lpar1', 'lpar2', 'lpar3', 'lpar4']
+
+        self.looper.update()
+
+        # One read, covering the three LPARs.
+        self.assertEqual(1, mock_list_cnas.call_count)
+        self.assertEqual(
+            {'lpar1', 'lpar2', 'lpar3'},
+            set(mock_list_cnas.call_args[1]['lpar_uuids']))
+        self.assertEqual(0, len(self.looper.requests))
+        self.assertEqual(12, self.mock_agent.update_device_up.call_count)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_lpar_uuids')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_cnas_by_lpar')
     def test_update_no_lpar(self, mock_list_cnas, mock_uuids):
-        req = sea_agent.UpdateVLANRequest(FakeNPort('a', 27, 'phys_net'))
+        req = self.build_update_req('aa:bb:cc:dd:ee:ff', 'lpar_uuid', 27)
         self.looper.add(req)
 
         # Mock the element returned
@@ -380,35 +705,225 @@ class PVIDLooperTest(base.BasePVMTestCase):
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
                 'list_lpar_uuids')
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'list_cnas')
-    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
-                'find_cna_for_mac')
-    def test_update_err(self, mock_find_cna_for_mac, mock_list_cnas,
-                        mock_list_lpar_uuids):
-        """Tests that the loop will error out after multiple loops."""
-        mock_net_dev = FakeNPort('a', 1000, 'phys_net')
-
-        req = sea_agent.UpdateVLANRequest(mock_net_dev)
+                'list_cnas_by_lpar')
+    def test_update_err(self, mock_list_cnas, mock_list_lpar_uuids):
+        """Tests that the request will error out after its deadline."""
+        cfg.CONF.set_override('pvid_update_timeout', 60, group='AGENT')
+        req = self.build_update_req('aa:bb:cc:dd:ee:ff', 'lpar_uuid', 1000)
         self.looper.add(req)
 
         # Mock the element returned
-        mock_list_lpar_uuids.return_value = 'lpar_uuid'
-        mock_list_cnas.return_value = [mock.Mock(mac='AABBCCDDEEFF', pvid=5)]
-        mock_find_cna_for_mac.return_value = None
-
-        loop_count = cfg.CONF.AGENT.pvid_update_loops
+        mock_list_lpar_uuids.return_value = ['lpar_uuid']
+        mock_list_cnas.return_value = {
+            'lpar_uuid': [mock.Mock(mac='AABBCCDDEE11', pvid=5)]}
 
-        for i in range(1, loop_count + 1):
-            # Call the update
-            self.looper.update()
+        # Before the deadline, the request is kept.
+        self.looper.update()
+        self.assertEqual(1, len(self.looper.requests))
+        self.assertFalse(self.mock_agent.update_device_down.called)
 
-            # Check to make sure the request was pulled off
-            required_count = 1 if i < loop_count else 0
-            self.assertEqual(required_count, len(self.looper.requests))
+        # Once it passes, the request is failed.
+        req.deadline = time.time() - 1
+        self.looper.update()
+        self.assertEqual(0, len(self.looper.requests))
 
         self.assertTrue(self.mock_agent.update_device_down.called)
         self.assertFalse(self.mock_agent.update_device_up.called)
 
+    def test_wake(self):
+        """Only changes to the LPARs with pending requests wake the looper."""
+        self.looper.add(self.build_update_req('aa', 'lpar1', 1))
+        self.looper._wakeup.clear()
+
+        self.looper.wake(lpar_uuid='lpar2')
+        self.assertFalse(self.looper._wakeup.is_set())
+        self.looper.wake(lpar_uuid='lpar1')
+        self.assertTrue(self.looper._wakeup.is_set())
+
+    def test_wait(self):
+        """The looper backs off while not woken, and sleeps when idle."""
+        # Idle, so blocks until a request is added.
+        req = self.build_update_req('aa', 'lpar1', 1)
+        eventlet.spawn_after(0.01, self.looper.add, req)
+        start = time.time()
+        self.assertEqual(self.looper.MIN_POLL_INTERVAL,
+                         self.looper._wait(30))
+        self.assertLess(time.time() - start, 5)
+
+        # Nothing happens, so the interval grows (up to the maximum).
+        self.assertEqual(0.02, self.looper._wait(0.01))
+
+        # The wait ends at the request's deadline.
+        req.deadline = time.time()
+        self.assertEqual(self.looper.MAX_POLL_INTERVAL,
+                         self.looper._wait(self.looper.MAX_POLL_INTERVAL))
+
+        # A wake up resets it.
+        self.looper.wake()
+        self.assertEqual(self.looper.MIN_POLL_INTERVAL,
+                         self.looper._wait(0.01))
+
+
+class NBWriteQueueTest(base.BasePVMTestCase):
+    """Validates the single writer per network bridge."""
+
+    def setUp(self):
+        super(NBWriteQueueTest, self).setUp()
+        cfg.CONF.set_override('nb_write_window_ms', 50, 'AGENT')
+        self.mock_agent = mock.MagicMock()
+        self.mock_agent.vlans_in_flight.return_value = {5}
+        self.writer = sea_agent.NBWriteQueue(self.mock_agent)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'remove_vlans_from_nb')
+    @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
+    def test_merge(self, mock_ensure, mock_remove):
+        """The writes within the window are made together."""
+        writes = [self.writer.add_vlans('nb_uuid', {1, 2}),
+                  self.writer.add_vlans('nb_uuid', {3}),
+                  self.writer.remove_vlans('nb_uuid', {2, 4, 5, 6})]
+        self.assertEqual(3, self.writer.stats['pending'])
+        for write in writes:
+            write.wait()
+
+        # VLAN 2 is added, so isn't removed.  VLAN 5 is being provisioned.
+        mock_ensure.assert_called_once_with(mock.ANY, mock.ANY, 'nb_uuid',
+                                            {1, 2, 3})
+        mock_remove.assert_called_once_with(mock.ANY, mock.ANY, 'nb_uuid',
+                                            [4, 6])
+        self.mock_agent.topology.invalidate_bridges.assert_called_once_with()
+
+        stats = self.writer.stats
+        self.assertEqual(0, stats['pending'])
+        self.assertEqual(3, stats['written'])
+        self.assertEqual(1, stats['batches'])
+        self.assertEqual(2, stats['updates'])
+        self.assertEqual(3.0, stats['merge_ratio'])
+        self.assertGreaterEqual(stats['max_latency'], 0.05)
+
+        # The writer stops once there is nothing left to write.
+        _wait_for_writes(self.writer)
+        self.assertEqual(0, len(self.writer._writers))
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'remove_vlans_from_nb')
+    @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
+    def test_separate_bridges(self, mock_ensure, mock_remove):
+        """Each bridge has its own writer."""
+        writes = [self.writer.add_vlans('nb1', {1}),
+                  self.writer.add_vlans('nb2', {2})]
+        self.assertEqual({'nb1', 'nb2'}, self.writer._writers)
+        for write in writes:
+            write.wait()
+        mock_ensure.assert_any_call(mock.ANY, mock.ANY, 'nb1', {1})
+        mock_ensure.assert_any_call(mock.ANY, mock.ANY, 'nb2', {2})
+        self.assertFalse(mock_remove.called)
+        self.assertEqual(2, self.writer.stats['batches'])
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'remove_vlans_from_nb')
+    @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
+    def test_write_fails(self, mock_ensure, mock_remove):
+        """A failed add only fails the writes that added VLANs."""
+        mock_ensure.side_effect = FakeException()
+        callback = mock.Mock()
+        add = self.writer.add_vlans('nb_uuid', {1}, callback=callback)
+        remove = self.writer.remove_vlans('nb_uuid', {4})
+
+        self.assertRaises(FakeException, add.wait)
+        remove.wait()
+        callback.assert_called_once_with(mock.ANY)
+        self.assertIsInstance(callback.call_args[0][0], FakeException)
+        mock_remove.assert_called_once_with(mock.ANY, mock.ANY, 'nb_uuid',
+                                            [4])
+
+    @mock.patch('pypowervm.tasks.network_bridger.ensure_vlans_on_nb')
+    def test_writer_error(self, mock_ensure):
+        """An unexpected error fails the writes, but not the next writer."""
+        self.mock_agent.topology.invalidate_bridges.side_effect = [
+            FakeException(), None]
+        callback = mock.Mock()
+        write = self.writer.add_vlans('nb_uuid', {1}, callback=callback)
+        self.assertRaises(FakeException, write.wait)
+        callback.assert_called_once_with(mock.ANY)
+        _wait_for_writes(self.writer)
+        self.assertEqual(set(), self.writer._writers)
+
+        # A new writer is started for the next write.
+        self.writer.add_vlans('nb_uuid', {2}).wait()
+        mock_ensure.assert_called_with(mock.ANY, mock.ANY, 'nb_uuid', {2})
+
+
+class CNAIndexTest(base.BasePVMTestCase):
+    """Validates the in memory index of the Client Network Adapters."""
+
+    def setUp(self):
+        super(CNAIndexTest, self).setUp()
+        self.index = sea_agent.CNAIndex(mock.Mock(), 'host_uuid')
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_cnas_by_lpar')
+    def test_find(self, mock_list_cnas):
+        cna1 = mock.Mock(mac='AABBCCDDEEFF')
+        cna2 = mock.Mock(mac='AABBCCDDEE11')
+        self.index.update('lpar1', [cna1, cna2])
+
+        # Either MAC format is found, and the API is not touched.
+        self.assertEqual(cna1, self.index.find('lpar1', 'aa:bb:cc:dd:ee:ff'))
+        self.assertEqual(cna2, self.index.find('lpar1', 'AABBCCDDEE11'))
+        self.assertFalse(mock_list_cnas.called)
+        self.assertEqual(2, self.index.hits)
+
+        # A miss reads the LPAR from the API.
+        mock_list_cnas.return_value = {'lpar1': [cna1, cna2]}
+        self.assertIsNone(self.index.find('lpar1', 'aa:bb:cc:dd:ee:00'))
+        mock_list_cnas.assert_called_once_with(mock.ANY, 'host_uuid',
+                                               lpar_uuids=['lpar1'])
+        self.assertEqual(1, self.index.misses)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_cnas_by_lpar')
+    def test_find_many(self, mock_list_cnas):
+        cna1 = mock.Mock(mac='AABBCCDDEEFF')
+        cna2 = mock.Mock(mac='AABBCCDDEE11')
+        cna3 = mock.Mock(mac='AABBCCDDEE22')
+        self.index.update('lpar1', [cna1])
+        mock_list_cnas.return_value = {'lpar2': [cna2, cna3]}
+
+        resp = self.index.find_many([('lpar1', 'aabbccddeeff'),
+                                     ('lpar2', 'aabbccddee11'),
+                                     ('lpar2', 'aabbccddee22'),
+                                     ('lpar2', 'aabbccddee33')])
+
+        # lpar2 is read just once, for all three of its MACs.
+        mock_list_cnas.assert_called_once_with(mock.ANY, 'host_uuid',
+                                               lpar_uuids=['lpar2'])
+        self.assertEqual({('lpar1', 'aabbccddeeff'): cna1,
+                          ('lpar2', 'aabbccddee11'): cna2,
+                          ('lpar2', 'aabbccddee22'): cna3}, resp)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_cnas')
+    def test_list_cnas_and_remove(self, mock_list_cnas):
+        cna1 = mock.Mock(mac='AABBCCDDEEFF')
+        self.index.update('lpar1', [cna1])
+        self.assertEqual([cna1], self.index.list_cnas('lpar1'))
+        self.assertFalse(mock_list_cnas.called)
+
+        # Once removed, the LPAR is read back in.
+        self.index.remove('lpar1')
+        mock_list_cnas.return_value = []
+        self.assertEqual([], self.index.list_cnas('lpar1'))
+        self.assertEqual(1, mock_list_cnas.call_count)
+
+    def test_reset_and_all_cnas(self):
+        cna1 = mock.Mock(mac='AABBCCDDEEFF')
+        cna2 = mock.Mock(mac='AABBCCDDEE11')
+        self.index.update('lpar3', [mock.Mock(mac='AABBCCDDEE22')])
+        self.index.reset({'lpar1': [cna1], 'lpar2': [cna2]})
+        self.assertEqual({cna1, cna2}, set(self.index.all_cnas()))
+        self.assertEqual(2, self.index.stats['lpars'])
+
 
 class CNAEventHandlerTest(base.BasePVMTestCase):
     """Validates that the CNAEventHandler can be invoked properly."""
@@ -418,17 +933,101 @@ class CNAEventHandlerTest(base.BasePVMTestCase):
 
         self.mock_agent = mock.MagicMock()
         self.handler = sea_agent.CNAEventHandler(self.mock_agent)
+        for worker in self.handler._workers:
+            self.addCleanup(worker.kill)
 
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.sea_agent.'
                 'CNAEventHandler._prov_reqs_for_uri')
     def test_process(self, mock_prov):
+        mock_prov.side_effect = lambda uri: ['req_' + uri]
         events = {'URI1': 'add', 'URI2': 'delete', 'URI3': 'invalidate'}
         self.handler.process(events)
 
-        # URI2 shouldn't be invoked.
+        # Every event is passed to the topology cache.
+        self.assertEqual(
+            3, self.mock_agent.topology.invalidate_for_uri.call_count)
+
+        # The URIs are only queued by the event callback.
+        self.assertFalse(mock_prov.called)
+        self.assertEqual(2, self.handler.stats['depth'])
+
+        # The workers resolve them.  URI2 shouldn't be invoked.
+        self.handler._uri_queue.join()
         self.assertEqual(2, mock_prov.call_count)
         mock_prov.assert_any_call('URI1')
         mock_prov.assert_any_call('URI3')
+        self.assertEqual(['req_URI1', 'req_URI3'],
+                         sorted(self.handler.get_queue()))
+        self.assertEqual(2, self.mock_agent.wake.call_count)
+
+        stats = self.handler.stats
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(2, stats['high_water'])
+        self.assertEqual(2, stats['received'])
+        self.assertEqual(2, stats['processed'])
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.sea_agent.'
+                'CNAEventHandler._prov_reqs_for_uri')
+    def test_process_debounce(self, mock_prov):
+        """A burst of events for a URI is resolved once."""
+        cfg.CONF.set_override('cna_event_debounce_ms', 100, group='AGENT')
+        mock_prov.return_value = []
+
+        self.handler.process({'URI1': 'add', 'URI2': 'add'})
+        for x in range(5):
+            self.handler.process({'URI1': 'invalidate'})
+        self.handler._uri_queue.join()
+
+        self.assertEqual(2, mock_prov.call_count)
+        self.assertEqual(7, self.handler.stats['received'])
+        self.assertEqual(2, self.handler.stats['processed'])
+
+        # Once resolved, a new event is looked up again.
+        self.handler.process({'URI1': 'invalidate'})
+        self.handler._uri_queue.join()
+        self.assertEqual(3, mock_prov.call_count)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.sea_agent.'
+                'CNAEventHandler._prov_reqs_for_uri')
+    def test_process_slow(self, mock_prov):
+        """A slow or failing lookup doesn't hold up the event delivery."""
+        cfg.CONF.set_override('cna_event_debounce_ms', 0, group='AGENT')
+
+        def prov_reqs(uri):
+            eventlet.sleep(0.1)
+            if uri == 'URI0':
+                raise Exception('error')
+            return [uri]
+        mock_prov.side_effect = prov_reqs
+
+        start = time.time()
+        for x in range(20):
+            self.handler.process({'URI%d' % x: 'add'})
+        self.assertLess(time.time() - start, 0.1)
+
+        # The workers run concurrently, and survive the error.
+        self.handler._uri_queue.join()
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(19, len(self.handler.get_queue()))
+        self.assertEqual(20, self.handler.stats['processed'])
+        self.assertGreaterEqual(self.handler.stats['max_latency'], 0.1)
+
+    def test_process_delete(self):
+        """A deleted LPAR is dropped from the adapter index."""
+        lpar_uri = ('https://9.1.2.3:12443/rest/api/uom/ManagedSystem/'
+                    'c5d782c7-44e4-3086-ad15-b16fb039d63b/LogicalPartition/'
+                    '3443DB77-AED1-47ED-9AA5-3DB9C6CF7089')
+        self.handler.process({lpar_uri: 'delete'})
+        self.mock_agent.cna_index.remove.assert_called_once_with(
+            '3443DB77-AED1-47ED-9AA5-3DB9C6CF7089')
+        self.mock_agent.mark_lpar_dirty.assert_called_once_with(
+            '3443DB77-AED1-47ED-9AA5-3DB9C6CF7089')
+
+        # A refresh of the event system clears the index, and asks for a full
+        # heal.
+        self.handler.process({'general': 'invalidate'})
+        self.mock_agent.cna_index.clear.assert_called_once_with()
+        self.mock_agent.request_full_heal.assert_called_once_with()
 
     def test_prov_reqs_for_uri_not_lpar(self):
         """Ensures that anything but a LogicalPartition returns empty."""
@@ -453,14 +1052,36 @@ class CNAEventHandlerTest(base.BasePVMTestCase):
 
         cna1 = mock.MagicMock(mac='aabbccddeeff')
         cna2 = mock.MagicMock(mac='aabbccddee11')
-        mock_list_cnas.return_value = [cna1, cna2]
+        cna3 = mock.MagicMock(mac='aabbccddee22')
+        mock_list_cnas.return_value = [cna1, cna2, cna3]
+
+        # Neutron doesn't know of the third (ex. an RMC adapter).
+        self.mock_agent.get_devices_details_list.return_value = [
+            {'device': 'aa:bb:cc:dd:ee:ff',
+             'mac_address': 'aa:bb:cc:dd:ee:ff'},
+            {'device': 'aa:bb:cc:dd:ee:11',
+             'mac_address': 'aa:bb:cc:dd:ee:11'},
+            {'device': 'aa:bb:cc:dd:ee:22'}]
 
         resp = self.handler._prov_reqs_for_uri(lpar_uri)
 
+        # The index was handed the adapters.
+        self.mock_agent.cna_index.update.assert_called_once_with(
+            '3443DB77-AED1-47ED-9AA5-3DB9C6CF7089', [cna1, cna2, cna3])
+        self.mock_agent.pvid_updater.wake.assert_called_once_with(
+            lpar_uuid='3443DB77-AED1-47ED-9AA5-3DB9C6CF7089')
+
         self.assertEqual(2, len(resp))
         for p_req in resp:
             self.assertIsInstance(p_req, agent_base.ProvisionRequest)
 
-        # Called the correct macs with the CNA.
-        self.mock_agent.get_device_details.assert_any_call('aa:bb:cc:dd:ee:ff')
-        self.mock_agent.get_device_details.assert_any_call('aa:bb:cc:dd:ee:11')
+        # A single call for all of the macs of the CNAs.
+        self.mock_agent.get_devices_details_list.assert_called_once_with(
+            ['aa:bb:cc:dd:ee:ff', 'aa:bb:cc:dd:ee:11', 'aa:bb:cc:dd:ee:22'])
+        self.assertFalse(self.mock_agent.get_device_details.called)
+
+        # No call if the LPAR has no CNAs.
+        self.mock_agent.get_devices_details_list.reset_mock()
+        mock_list_cnas.return_value = []
+        self.assertEqual([], self.handler._prov_reqs_for_uri(lpar_uri))
+        self.assertFalse(self.mock_agent.get_devices_details_list.called)
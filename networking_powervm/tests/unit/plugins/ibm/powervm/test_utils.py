@@ -14,6 +14,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
 import mock
 
 from networking_powervm.plugins.ibm.agent.powervm import exceptions as np_exc
@@ -25,6 +26,7 @@ from pypowervm import exceptions as pvm_exc
 from pypowervm.helpers import log_helper as pvm_log
 from pypowervm.tests import test_fixtures as pvm_fx
 from pypowervm.tests.test_utils import pvmhttp
+from pypowervm.wrappers import logical_partition as pvm_lpar
 from pypowervm.wrappers import network as pvm_net
 
 NET_BR_FILE = 'fake_network_bridge.txt'
@@ -32,6 +34,8 @@ VM_FILE = 'fake_lpar_feed.txt'
 CNA_FILE = 'fake_cna.txt'
 VSW_FILE = 'fake_virtual_switch.txt'
 VIOS_FILE = 'fake_vios_feed3.txt'
+MGR_NET_BR_FILE = 'nbbr_network_bridge.txt'
+MGR_NB_UUID = 'b6a027a8-5c0b-3ac0-8547-b516f5ba6151'
 
 
 class UtilsTest(base.BasePVMTestCase):
@@ -40,8 +44,9 @@ class UtilsTest(base.BasePVMTestCase):
     def setUp(self):
         super(UtilsTest, self).setUp()
 
-        self.adpt = self.useFixture(
-            pvm_fx.AdapterFx(traits=pvm_fx.LocalPVMTraits)).adpt
+        self.adptfx = self.useFixture(
+            pvm_fx.AdapterFx(traits=pvm_fx.LocalPVMTraits))
+        self.adpt = self.adptfx.adpt
 
         def resp(file_name):
             return pvmhttp.load_pvm_resp(
@@ -53,40 +58,15 @@ class UtilsTest(base.BasePVMTestCase):
         self.vswitch_resp = resp(VSW_FILE)
         self.vios_feed_resp = resp(VIOS_FILE)
 
+        # Start each test without any previously read feeds.
+        utils.invalidate_feed_cache()
+
     def _mock_feed(self, feed):
         """Helper method to make the mock adapter."""
         # Sets the feed to be the response on the adapter for a single read
         self.adpt.read.return_value = feed
         self.adpt.read_by_href.return_value = feed
 
-    def __cna(self, mac):
-        """Create a Client Network Adapter mock."""
-
-        class FakeCNA(object):
-
-            @property
-            def slot(self):
-                return 1
-
-            @property
-            def mac(self):
-                return mac
-
-            @property
-            def pvid(self):
-                return 1
-
-        return FakeCNA()
-
-    def test_find_cna_for_mac(self):
-        cna1 = self.__cna("1234567890AB")
-        cna2 = self.__cna("123456789012")
-
-        self.assertEqual(cna1, utils.find_cna_for_mac("1234567890AB",
-                                                      [cna1, cna2]))
-        self.assertEqual(None, utils.find_cna_for_mac("9876543210AB",
-                                                      [cna1, cna2]))
-
     def test_norm_mac(self):
         EXPECTED = "12:34:56:78:90:ab"
         self.assertEqual(EXPECTED, utils.norm_mac("12:34:56:78:90:ab"))
@@ -123,30 +103,93 @@ class UtilsTest(base.BasePVMTestCase):
                          resp[0])
         mock_read.assert_called_once_with('ManagedSystem',
                                           child_type='VirtualSwitch',
-                                          root_id='host_uuid')
-
-    def test_find_nb_for_cna(self):
+                                          root_id='host_uuid', etag=None)
+
+    def test_read_feed(self):
+        """Validates the conditional (etag based) reads of a feed."""
+        wrap_func = mock.Mock(return_value=['wrap1', 'wrap2'])
+        self.adpt.read = mock.Mock(return_value=mock.Mock(status=200,
+                                                          etag='etag1'))
+
+        # First read has no etag to send.
+        resp = utils._read_feed(self.adpt, wrap_func, 'ManagedSystem',
+                                root_id='host_uuid', child_type='VSwitch')
+        self.assertEqual(['wrap1', 'wrap2'], resp)
+        self.adpt.read.assert_called_once_with(
+            'ManagedSystem', root_id='host_uuid', child_type='VSwitch',
+            etag=None)
+
+        # The second sends the etag, and the 304 gets the same wrappers back
+        # without re-wrapping the response.
+        self.adpt.read.reset_mock()
+        self.adpt.read.return_value = mock.Mock(
+            status=pvm_const.HTTPStatus.NO_CHANGE, etag='etag1')
+        resp = utils._read_feed(self.adpt, wrap_func, 'ManagedSystem',
+                                root_id='host_uuid', child_type='VSwitch')
+        self.assertEqual(['wrap1', 'wrap2'], resp)
+        self.adpt.read.assert_called_once_with(
+            'ManagedSystem', root_id='host_uuid', child_type='VSwitch',
+            etag='etag1')
+        self.assertEqual(1, wrap_func.call_count)
+
+        stats = utils.feed_cache_stats()
+        self.assertEqual(1, stats['feeds'])
+        self.assertEqual(1, stats['not_modified'])
+
+        # The feed is forgotten while the read is in flight.  The 304 still
+        # gets the wrappers back.
+        def read(*args, **kwargs):
+            utils.invalidate_feed_cache()
+            return mock.Mock(status=pvm_const.HTTPStatus.NO_CHANGE,
+                             etag='etag1')
+        self.adpt.read.side_effect = read
+        resp = utils._read_feed(self.adpt, wrap_func, 'ManagedSystem',
+                                root_id='host_uuid', child_type='VSwitch')
+        self.assertEqual(['wrap1', 'wrap2'], resp)
+        self.assertEqual(1, utils.feed_cache_stats()['feeds'])
+
+        # A failed read forgets the feed.
+        err_resp = mock.MagicMock(status=404)
+        self.adpt.read.side_effect = pvm_exc.HttpError(err_resp)
+        self.assertRaises(pvm_exc.HttpError, utils._read_feed, self.adpt,
+                          wrap_func, 'ManagedSystem', root_id='host_uuid',
+                          child_type='VSwitch')
+        self.assertEqual(0, utils.feed_cache_stats()['feeds'])
+
+    def test_read_feed_size(self):
+        """The remembered feeds are bounded in size."""
+        self.adpt.read = mock.Mock(return_value=mock.Mock(status=200,
+                                                          etag='etag'))
+        with mock.patch.object(utils, 'FEED_CACHE_SIZE', new=2):
+            for root_id in ('1', '2', '3'):
+                utils._read_feed(self.adpt, mock.Mock(return_value=[]),
+                                 'LogicalPartition', root_id=root_id,
+                                 child_type='ClientNetworkAdapter')
+
+        # The least recently used feed was dropped.
+        self.assertEqual(2, utils.feed_cache_stats()['feeds'])
+        self.assertNotIn(('LogicalPartition', '1', 'ClientNetworkAdapter', ()),
+                         utils._FEED_CACHE)
+
+    def test_build_nb_vlan_map(self):
+        """The lookup table finds the first bridge with the VLAN."""
         self._mock_feed(self.vswitch_resp)
 
         nb_wraps = pvm_net.NetBridge.wrap(self.net_br_resp)
-
-        mock_client_adpt = mock.MagicMock()
-        mock_client_adpt.vswitch_uri = ('https://9.1.2.3:12443/rest/api/uom/'
-                                        'ManagedSystem/'
-                                        'c5d782c7-44e4-3086-ad15-b16fb039d63b/'
-                                        'VirtualSwitch/'
-                                        'e1a852cb-2be5-3a51-9147-43761bc3d720')
-
         vswitch_map = utils.get_vswitch_map(self.adpt, 'host_uuid')
+        nb_vlan_map = utils.build_nb_vlan_map(nb_wraps, vswitch_map)
 
-        # Should have a proper URI, so it should match
-        resp = utils.find_nb_for_cna(nb_wraps, mock_client_adpt, vswitch_map)
-        self.assertIsNotNone(resp)
+        vsw_uri = ('https://9.1.2.3:12443/rest/api/uom/ManagedSystem/'
+                   'c5d782c7-44e4-3086-ad15-b16fb039d63b/VirtualSwitch/'
+                   'e1a852cb-2be5-3a51-9147-43761bc3d720')
+        for nb_wrap in nb_wraps:
+            for vlan in nb_wrap.list_vlans():
+                expected = [x for x in nb_wraps if x.supports_vlan(vlan)][0]
+                self.assertEqual(expected, nb_vlan_map.get((vsw_uri, vlan)))
 
-        # Should not match if we change the vswitch URI
-        mock_client_adpt.vswitch_uri = "Fake"
-        resp = utils.find_nb_for_cna(nb_wraps, mock_client_adpt, vswitch_map)
-        self.assertIsNone(resp)
+        # Unknown vSwitches are not in the table.
+        vlan = nb_wraps[0].list_vlans()[0]
+        self.assertIsNone(nb_vlan_map.get(('Fake', vlan)))
 
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
                 '_list_vm_entries')
@@ -180,6 +223,61 @@ class UtilsTest(base.BasePVMTestCase):
         cnas = utils.list_cnas(self.adpt, 'host_uuid')
         self.assertEqual(1, len(cnas))
 
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                '_list_vm_entries')
+    @mock.patch('pypowervm.wrappers.network.CNA.wrap')
+    def test_list_cnas_by_lpar(self, mock_cna_wrap, mock_list_vms):
+        """Validates the CNAs are grouped by their owning VM."""
+        mock_list_vms.return_value = [mock.Mock(uuid='1'), mock.Mock(uuid='2')]
+        mock_cna_wrap.side_effect = [['cna1'], ['cna2', 'cna3']]
+        self.adpt.read = mock.Mock()
+
+        resp = utils.list_cnas_by_lpar(self.adpt, 'host_uuid')
+        self.assertEqual({'1': ['cna1'], '2': ['cna2', 'cna3']}, resp)
+
+        # Only the requested VMs should be read.
+        mock_list_vms.reset_mock()
+        mock_cna_wrap.side_effect = [['cna4']]
+        resp = utils.list_cnas_by_lpar(self.adpt, 'host_uuid',
+                                       lpar_uuids=['3'])
+        self.assertEqual({'3': ['cna4']}, resp)
+        self.assertFalse(mock_list_vms.called)
+
+    @mock.patch('pypowervm.wrappers.logical_partition.LPAR.wrap')
+    @mock.patch('pypowervm.wrappers.network.CNA.wrap')
+    def test_list_cnas_rest_calls(self, mock_cna_wrap, mock_lpar_wrap):
+        """Counts the REST calls a full CNA inventory makes at scale."""
+        mock_cna_wrap.return_value = ['cna']
+        mock_lpar_wrap.side_effect = lambda entry: entry
+
+        for lpar_count in (10, 100, 1000):
+            stats = {'reads': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+            def read(root_type, root_id=None, child_type=None, **kwargs):
+                stats['reads'] += 1
+                if child_type == pvm_lpar.LPAR.schema_type:
+                    entries = [mock.Mock(uuid=str(x))
+                               for x in range(lpar_count)]
+                    return mock.Mock(feed=mock.Mock(entries=entries))
+
+                # Yield while 'in flight' so the concurrency is observable.
+                stats['in_flight'] += 1
+                stats['max_in_flight'] = max(stats['max_in_flight'],
+                                             stats['in_flight'])
+                eventlet.sleep(0)
+                stats['in_flight'] -= 1
+                return mock.Mock()
+            self.adpt.read = read
+
+            cnas = utils.list_cnas(self.adpt, 'host_uuid')
+
+            # One read for the VM feed, and one per VM.  The VM reads are
+            # bounded in how many run at once.
+            self.assertEqual(lpar_count, len(cnas))
+            self.assertEqual(lpar_count + 1, stats['reads'])
+            self.assertEqual(min(lpar_count, utils.CNA_READ_CONCURRENCY),
+                             stats['max_in_flight'])
+
     @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
                 'list_bridges')
     def test_parse_sea_mappings(self, mock_list_br):
@@ -257,7 +355,8 @@ class UtilsTest(base.BasePVMTestCase):
 
         # Attempt happy path
         cna = build_mock()
-        utils.update_cna_pvid(cna, 5)
+        self.assertEqual(cna.update.return_value,
+                         utils.update_cna_pvid(cna, 5))
         self.assertEqual(5, cna.pvid)
         self.assertEqual(1, cna.update.call_count)
 
@@ -269,7 +368,12 @@ class UtilsTest(base.BasePVMTestCase):
         error = pvm_exc.HttpError(err_resp)
 
         cna.update.side_effect = [error, error, error]
-        self.assertRaises(pvm_exc.HttpError, utils.update_cna_pvid, cna, 5)
+        with mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                        'invalidate_feed_cache') as mock_invalidate:
+            self.assertRaises(pvm_exc.HttpError, utils.update_cna_pvid, cna,
+                              5)
+            mock_invalidate.assert_called_once_with(
+                child_type=pvm_net.CNA.schema_type)
         self.assertEqual(3, cna.update.call_count)
         self.assertEqual(2, cna.refresh.call_count)
 
@@ -288,3 +392,112 @@ class UtilsTest(base.BasePVMTestCase):
         self.assertRaises(pvm_exc.HttpError, utils.update_cna_pvid, cna, 5)
         self.assertEqual(1, cna.update.call_count)
         self.assertEqual(0, cna.refresh.call_count)
+
+    def _test_remove_vlans_from_nb(self, validate_nb):
+        # The bridge has VLAN 2227 on its primary load group, and VLAN 1000
+        # alone on its second load group.
+        self.adpt.read.return_value = pvmhttp.load_pvm_resp(
+            MGR_NET_BR_FILE, adapter=self.adpt).get_response()
+
+        def validate_update(*kargs, **kwargs):
+            validate_nb(kargs[0])
+            return kargs[0].entry
+        self.adpt.update_by_path.side_effect = validate_update
+
+        # Only VLAN 1000 can be removed.  The bridge is read and updated
+        # once.
+        self.assertEqual([1000], utils.remove_vlans_from_nb(
+            self.adpt, 'host_uuid', MGR_NB_UUID, [2227, 1000, 5]))
+        self.assertEqual(1, self.adpt.read.call_count)
+        self.assertEqual(1, self.adpt.update_by_path.call_count)
+
+        # Nothing that can be removed, so no update.
+        self.assertEqual([], utils.remove_vlans_from_nb(
+            self.adpt, 'host_uuid', MGR_NB_UUID, [2227, 5]))
+        self.assertEqual(1, self.adpt.update_by_path.call_count)
+
+    def test_remove_vlans_from_nb(self):
+        """Validates the removal of VLANs from a Network Bridge."""
+        def validate_nb(nb):
+            # The trunk adapter for VLAN 1000 is removed from the SEA.
+            self.assertEqual(0, len(nb.seas[0].addl_adpts))
+        self._test_remove_vlans_from_nb(validate_nb)
+
+    def test_remove_vlans_from_nb_vnet(self):
+        """Emptied load groups are removed from a vnet aware bridge."""
+        self.adptfx.set_traits(pvm_fx.RemoteHMCTraits)
+
+        def validate_nb(nb):
+            # The load group for VLAN 1000 is removed.
+            self.assertEqual(1, len(nb.load_grps))
+        self._test_remove_vlans_from_nb(validate_nb)
+
+
+class TopologyCacheTest(base.BasePVMTestCase):
+    """Validates the caching of the host's network topology."""
+
+    def setUp(self):
+        super(TopologyCacheTest, self).setUp()
+        self.cache = utils.TopologyCache(mock.Mock(), 'host_uuid')
+        self.ms_uri = ('https://9.1.2.3:12443/rest/api/uom/ManagedSystem/'
+                       'c5d782c7-44e4-3086-ad15-b16fb039d63b')
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'get_vswitch_map')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_bridges')
+    def test_cache(self, mock_list_br, mock_vs_map):
+        for x in range(3):
+            self.cache.list_bridges()
+            self.cache.get_vswitch_map()
+
+        self.assertEqual(1, mock_list_br.call_count)
+        self.assertEqual(1, mock_vs_map.call_count)
+        self.assertEqual({'hits': 4, 'misses': 2}, self.cache.stats)
+
+        # A NetworkBridge event only invalidates the bridges
+        self.assertTrue(self.cache.invalidate_for_uri(
+            self.ms_uri + '/NetworkBridge/nb_uuid'))
+        self.cache.list_bridges()
+        self.cache.get_vswitch_map()
+        self.assertEqual(2, mock_list_br.call_count)
+        self.assertEqual(1, mock_vs_map.call_count)
+
+        # Neither a VIOS nor an LPAR event changes the topology.
+        self.assertFalse(self.cache.invalidate_for_uri(
+            self.ms_uri + '/VirtualIOServer/vio'))
+        self.assertFalse(self.cache.invalidate_for_uri(
+            self.ms_uri + '/LogicalPartition/lpar'))
+        self.cache.list_bridges()
+        self.assertEqual(2, mock_list_br.call_count)
+
+        # While a reset of the event system invalidates everything.
+        self.cache.invalidate_for_uri('general')
+        self.cache.list_bridges()
+        self.cache.get_vswitch_map()
+        self.assertEqual(3, mock_list_br.call_count)
+        self.assertEqual(2, mock_vs_map.call_count)
+
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'build_nb_vlan_map')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'get_vswitch_map')
+    @mock.patch('networking_powervm.plugins.ibm.agent.powervm.utils.'
+                'list_bridges')
+    def test_nb_vlan_map(self, mock_list_br, mock_vs_map, mock_build):
+        """The lookup table is only rebuilt when the topology changes."""
+        self.cache.get_nb_vlan_map()
+        self.cache.get_nb_vlan_map()
+        self.assertEqual(1, mock_build.call_count)
+
+        # A bridge change rebuilds.
+        self.cache.invalidate_for_uri(self.ms_uri + '/NetworkBridge/nb_uuid')
+        self.cache.get_nb_vlan_map()
+        self.assertEqual(2, mock_build.call_count)
+
+        # As does a vSwitch change.
+        self.cache.invalidate_for_uri(self.ms_uri + '/VirtualSwitch/vs_uuid')
+        self.cache.get_nb_vlan_map()
+        self.assertEqual(3, mock_build.call_count)
+        self.assertEqual(2, mock_list_br.call_count)
+        self.assertEqual(2, mock_vs_map.call_count)
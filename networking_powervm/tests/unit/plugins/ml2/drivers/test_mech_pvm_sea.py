@@ -16,6 +16,8 @@
 
 import mock
 
+from oslo_config import cfg
+
 from networking_powervm.plugins.ml2.drivers import mech_pvm_sea as m_pvm
 from networking_powervm.tests.unit.plugins.ibm.powervm import base
 
@@ -47,8 +49,117 @@ class TestPvmMechDriver(base.BasePVMTestCase):
                         api.PHYSICAL_NETWORK: 'default'}
         fake_context = mock.MagicMock()
         self.mech_drv.rpc_publisher = mock.MagicMock()
+        agent = {'host': 'host1',
+                 'configurations': {'port_update_host_topic': True}}
         self.mech_drv.try_to_bind_segment_for_agent(fake_context, fake_segment,
-                                                    None)
+                                                    agent)
         self.mech_drv.rpc_publisher.port_update.assert_called_with(
-                fake_context._plugin_context, fake_context._port,
-                'vlan', '1000', 'default')
+                fake_context._plugin_context, port=fake_context._port,
+                network_type='vlan', segmentation_id='1000',
+                physical_network='default', host='host1')
+
+        # An older agent doesn't listen on its host's topic, so the update
+        # is fanned out.
+        self.mech_drv.try_to_bind_segment_for_agent(fake_context, fake_segment,
+                                                    {'host': 'host1'})
+        self.mech_drv.rpc_publisher.port_update.assert_called_with(
+                fake_context._plugin_context, port=fake_context._port,
+                network_type='vlan', segmentation_id='1000',
+                physical_network='default', host=None)
+
+    @mock.patch('neutron.context.get_admin_context')
+    @mock.patch('eventlet.spawn_after')
+    def test_port_update_batch(self, mock_spawn, mock_admin_ctx):
+        """Ports bound within the window are sent in one message."""
+        cfg.CONF.set_override('port_update_batch_window', 0.5,
+                              group='ml2_powervm')
+        self.mech_drv.rpc_publisher = mock.MagicMock()
+        agent = {'host': 'host1',
+                 'configurations': {'ports_update': True,
+                                    'port_update_host_topic': True}}
+
+        def notify(port, agent=agent):
+            fake_context = mock.MagicMock(_port=port)
+            fake_segment = {api.NETWORK_TYPE: 'vlan',
+                            api.SEGMENTATION_ID: '1000',
+                            api.PHYSICAL_NETWORK: 'default'}
+            self.mech_drv._notify_port_update(fake_context, fake_segment,
+                                              agent)
+
+        def update(port):
+            return {'port': port, 'network_type': 'vlan',
+                    'segmentation_id': '1000', 'physical_network': 'default'}
+
+        # Only the first port schedules the flush.
+        notify('p1')
+        notify('p2')
+        mock_spawn.assert_called_once_with(
+            0.5, self.mech_drv._flush_port_updates, 'host1')
+        self.assertFalse(self.mech_drv.rpc_publisher.port_update.called)
+
+        self.mech_drv._flush_port_updates('host1')
+        self.mech_drv.rpc_publisher.ports_update.assert_called_once_with(
+            mock_admin_ctx.return_value, [update('p1'), update('p2')],
+            'host1')
+
+        # A batch of one is a normal port update.
+        notify('p3')
+        self.mech_drv._flush_port_updates('host1')
+        self.mech_drv.rpc_publisher.port_update.assert_called_once_with(
+            mock_admin_ctx.return_value, host='host1', **update('p3'))
+        self.assertEqual(2, mock_spawn.call_count)
+
+        # An agent that doesn't support the bulk update is sent each port.
+        notify('p4', agent={'host': 'host2', 'configurations': {}})
+        self.assertEqual(2, self.mech_drv.rpc_publisher.port_update.call_count)
+        self.assertEqual(2, mock_spawn.call_count)
+
+    @mock.patch('neutron.context.get_admin_context')
+    def test_flush_port_updates_fails(self, mock_admin_ctx):
+        """A batch that can't be sent falls back to a cast per port."""
+        self.mech_drv.rpc_publisher = mock.MagicMock()
+        publisher = self.mech_drv.rpc_publisher
+        publisher.ports_update.side_effect = Exception()
+        publisher.port_update.side_effect = [Exception(), None]
+        updates = [{'port': {'id': 'p1'}}, {'port': {'id': 'p2'}}]
+        for update in updates:
+            self.mech_drv._queue_port_update('host1', update)
+
+        # The failures are logged rather than raised.
+        self.mech_drv._flush_port_updates('host1')
+        publisher.ports_update.assert_called_once_with(
+            mock_admin_ctx.return_value, updates, 'host1')
+        publisher.port_update.assert_has_calls([
+            mock.call(mock_admin_ctx.return_value, host='host1',
+                      port={'id': 'p1'}),
+            mock.call(mock_admin_ctx.return_value, host='host1',
+                      port={'id': 'p2'})])
+
+    def test_port_update_targeted(self):
+        """The port update is cast only to the binding host's topic."""
+        notifier = m_pvm.PvmSEANotifierApi('q-agent-notifier')
+        notifier.client = mock.MagicMock()
+        cctxt = notifier.client.prepare.return_value
+
+        notifier.port_update('ctx', 'port', 'vlan', '1000', 'default',
+                             host='host1')
+        notifier.client.prepare.assert_called_once_with(
+            topic='q-agent-notifier-port-update.host1', fanout=False)
+        cctxt.cast.assert_called_once_with(
+            'ctx', 'port_update', port='port', network_type='vlan',
+            segmentation_id='1000', physical_network='default')
+
+        # Without a host, falls back to the fanout.
+        notifier.client.reset_mock()
+        notifier.port_update('ctx', 'port', 'vlan', '1000', 'default')
+        notifier.client.prepare.assert_called_once_with(
+            topic='q-agent-notifier-port-update', fanout=True)
+
+        # The bulk update is cast to the host at the newer version.
+        notifier.client.reset_mock()
+        notifier.ports_update('ctx', ['update'], 'host1')
+        notifier.client.prepare.assert_called_once_with(
+            topic='q-agent-notifier-port-update.host1', fanout=False,
+            version='1.3')
+        cctxt.cast.assert_called_once_with('ctx', 'ports_update',
+                                           ports=['update'])